@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+"""
+This script benchmarks the functions in data_conversion_util.py on synthetic data,
+so that changes in their speed and memory use can be compared between versions.
+
+It generates synthetic participant records (nested json objects with repeated trials),
+then times and measures the peak memory of load_json(), flatten(), fill_missing_keys(),
+cut_and_stack(), longest_common_substring() and list2csv() at several scales.
+The results of each run are added to a json file together with the git version, and
+compared with the previous run in the same file.
+
+Usage:
+    python data_conversion_benchmark.py [--records 100,1000,10000] [--reps 40] [--depth 2]
+                                        [--sparsity 0.1] [--output benchmark_results.json]
+"""
+
+import os
+import sys
+import json
+import collections
+import time
+import random
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+
+import data_conversion_util as dcu
+
+
+def generate_records(n_records, depth=2, n_reps=40, n_fields=6, sparsity=0.1, seed=0):
+    """
+    Generate synthetic participant records, similar to the json data of a task.
+    :param n_records: (integer) number of records (participants)
+    :param depth: (integer) nesting depth of the fields in each trial (1: no nesting)
+    :param n_reps: (integer) number of repetitions (trials) in each record
+    :param n_fields: (integer) number of fields in each trial
+    :param sparsity: (float) probability that a field is missing from a trial
+    :param seed: random seed
+    :return: a list of dictionaries
+    """
+    rng = random.Random(seed)
+
+    def _trial():
+        trial = {}
+        for f in range(n_fields):
+            if rng.random() < sparsity:
+                continue
+            kind = f % 4
+            value = (rng.random() if kind == 0 else rng.randint(0, 100) if kind == 1
+                     else rng.choice(['left', 'right', 'none']) if kind == 2 else rng.random() < 0.5)
+            node = trial
+            for level in range(depth - 1):  # nest the field in depth - 1 dictionaries
+                node = node.setdefault('level%d_%d' % (level, f % 2), {})
+            node['field%d' % f] = value
+        return trial
+
+    return [{'participant': 'p%06d' % i,
+             'demographics': {'age': rng.randint(18, 40), 'handedness': rng.choice(['l', 'r'])},
+             'trials': [_trial() for _ in range(n_reps)],
+             'comments': rng.choice(['', 'ok', 'tired', None])}
+            for i in range(n_records)]
+
+
+def trial_layout(col_names):
+    """
+    Work out the cut_and_stack() arguments for the columns of the records from generate_records(),
+    using only the column names, so that the same arguments work with every version of cut_and_stack().
+    The repetitions are the 'trials.N.' columns. A trial that is missing a field in every record
+    (possible with sparse data) has fewer columns than the others, so its columns are skipped.
+    :param col_names: (list) sorted column names from fill_missing_keys()
+    :return: a dictionary {'cut_start', 'cut_length', 'cut_number', 'skip_cols'}
+    """
+    trials = collections.OrderedDict()  # {trial number: column indexes}
+    for i, name in enumerate(col_names):
+        if name.startswith('trials.'):
+            trials.setdefault(name.split('.')[1], []).append(i)
+    cut_length = collections.Counter(len(cols) for cols in trials.values()).most_common(1)[0][0]
+    cut_trials = [cols for cols in trials.values() if len(cols) == cut_length]
+    skip_cols = [i for cols in trials.values() if len(cols) != cut_length for i in cols]
+    return {'cut_start': cut_trials[0][0], 'cut_length': cut_length, 'cut_number': len(cut_trials),
+            'skip_cols': skip_cols}
+
+
+def measure(function, *args, **kwargs):
+    """
+    Run a function twice, to time it and then to measure its peak memory use (with tracemalloc,
+    which slows it down).
+    :return: seconds, peak memory in bytes, and the return value of the function
+    """
+    start_time = time.perf_counter()
+    result = function(*args, **kwargs)
+    seconds = time.perf_counter() - start_time
+    del result
+    tracemalloc.start()
+    result = function(*args, **kwargs)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak, result
+
+
+def run_benchmarks(n_records, **generator_kwargs):
+    """
+    Benchmark the data conversion functions on one scale.
+    :param n_records: (integer) number of records
+    :param generator_kwargs: other parameters for generate_records()
+    :return: a list of dictionaries {'function', 'records', 'seconds', 'peak_bytes'}
+    """
+    records = generate_records(n_records, **generator_kwargs)
+    temp_dir = tempfile.mkdtemp(prefix='data_conversion_benchmark_')
+    json_file = os.path.join(temp_dir, 'records.json')
+    with open(json_file, 'w') as outfile:
+        for record in records:
+            outfile.write(json.dumps(record) + '\n')
+
+    results = []
+
+    def _add(name, seconds, peak):
+        results.append({'function': name, 'records': n_records, 'seconds': seconds, 'peak_bytes': peak})
+
+    seconds, peak, _ = measure(dcu.load_json, json_file, multiple_obj=True)
+    _add('load_json', seconds, peak)
+    seconds, peak, data_list = measure(lambda: [dcu.flatten(r, r['participant']) for r in records])
+    _add('flatten', seconds, peak)
+    seconds, peak, (col_names, data) = measure(dcu.fill_missing_keys, data_list)
+    _add('fill_missing_keys', seconds, peak)
+
+    cut_kwargs = trial_layout(col_names)
+    seconds, peak, (long_cols, long_data) = measure(dcu.cut_and_stack, col_names, data, **cut_kwargs)
+    _add('cut_and_stack', seconds, peak)
+    pairs = [(a, b) for a in col_names[:200] for b in col_names[:20]]
+    seconds, peak, _ = measure(lambda: [dcu.longest_common_substring(a, b) for a, b in pairs])
+    _add('longest_common_substring (%d pairs)' % len(pairs), seconds, peak)
+    seconds, peak, _ = measure(dcu.list2csv, long_data, os.path.join(temp_dir, 'long.csv'), long_cols)
+    _add('list2csv', seconds, peak)
+
+    for filename in os.listdir(temp_dir):
+        os.remove(os.path.join(temp_dir, filename))
+    os.rmdir(temp_dir)
+    return results
+
+
+def git_version():
+    """
+    :return: the git version of this repository, or 'unknown'
+    """
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark data_conversion_util.py on synthetic data.')
+    parser.add_argument('--records', default='100,1000,10000',
+                        help='comma separated numbers of records (default: 100,1000,10000)')
+    parser.add_argument('--reps', type=int, default=40, help='number of trials in each record (default: 40)')
+    parser.add_argument('--fields', type=int, default=6, help='number of fields in each trial (default: 6)')
+    parser.add_argument('--depth', type=int, default=2, help='nesting depth of the trial fields (default: 2)')
+    parser.add_argument('--sparsity', type=float, default=0.1,
+                        help='probability that a field is missing (default: 0.1)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed (default: 0)')
+    parser.add_argument('--output', default='benchmark_results.json',
+                        help='json file to add the results to (default: benchmark_results.json)')
+    args = parser.parse_args()
+
+    run = {'version': git_version(), 'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+           'python': sys.version.split()[0], 'platform': platform.platform(),
+           'parameters': {'reps': args.reps, 'fields': args.fields, 'depth': args.depth,
+                          'sparsity': args.sparsity, 'seed': args.seed},
+           'results': []}
+    for n_records in [int(n) for n in args.records.split(',')]:
+        run['results'].extend(run_benchmarks(n_records, depth=args.depth, n_reps=args.reps,
+                                             n_fields=args.fields, sparsity=args.sparsity, seed=args.seed))
+
+    runs = []
+    if os.path.exists(args.output):
+        with open(args.output, 'r') as infile:
+            runs = json.load(infile)
+    previous = {}  # results of the last run with the same parameters
+    for old_run in runs:
+        if old_run['parameters'] == run['parameters']:
+            previous = {(r['function'], r['records']): r for r in old_run['results']}
+
+    print('Version %s%s' % (run['version'], ' (compared with the previous run)' if previous else ''))
+    print('%-40s %8s %10s %12s %10s' % ('function', 'records', 'seconds', 'peak MB', 'speedup'))
+    for r in run['results']:
+        old = previous.get((r['function'], r['records']))
+        speedup = '%.2fx' % (old['seconds'] / r['seconds']) if old and r['seconds'] > 0 else ''
+        print('%-40s %8d %10.4f %12.2f %10s' % (r['function'], r['records'], r['seconds'],
+                                                r['peak_bytes'] / 2.0 ** 20, speedup))
+
+    runs.append(run)
+    with open(args.output, 'w') as outfile:
+        json.dump(runs, outfile, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,7 +8,7 @@
 """
 This script contains a few functions to convert data files between
 json, csv and python dictionary/list, or wide and long format.
-e.g. converting a json file to a python dictionary or a pickle file,
+e.g. converting a json file to a python dictionary (optionally cached on disk),
      flatten the dictionary to a list,
      converting data from wide format to long format,
      save the list as a csv file, etc.
@@ -16,11 +16,11 @@ e.g. converting a json file to a python dictionary or a pickle file,
 Example 1: Convert a json file containing only one json object to a csv file
     # Read a json file to a dictionary
     # This might take a while, so if you need to load a same large json file multiple times
-    # you can save it as a pickle file and then read from the pickle file instead.
-    # Just omit the pkl_file parameter if you don't need that.
-    data_dict = load_json('data.json', pkl_file='temp.pkl')
-    # with open('temp.pkl', 'r') as infile:
-    #     data_dict = pickle.load(infile)
+    # you can cache the parsed result in a directory, so the file is only parsed again
+    # when it changes. Just omit the cache parameter if you don't need that.
+    # The cache index is saved when the with block ends (or when you call cache.close()).
+    with JsonCache('json_cache/') as cache:
+        data_dict = load_json('data.json', cache=cache)
 
     # Flatten the dictionary to a list
     # data_list is a list of tuples (col_names, values)
@@ -39,108 +39,973 @@ Example 1: Convert a json file containing only one json object to a csv file
     list2csv(long_data, 'long_data.csv', long_cols)
 
 Example 2: Convert a folder of json files, each containing multiple json objects, to a csv file
-    # Read json files from DATA_FOLDER, and flatten each file
-    # Take the file names as IDs while ignoring the last four characters (file extensions)
-    data = [flatten(load_json(DATA_FOLDER + datafile, multiple_obj=True), obj_id=datafile[:-4])
-            for datafile in os.listdir(DATA_FOLDER)]
-    col_names, data = fill_missing_keys(data)
+    # The files are read and flattened by a pool of processes (one per CPU by default).
+    # The new processes may import the script again (on macOS and Windows, and on Linux from
+    # Python 3.14), so the script has to call these functions under if __name__ == '__main__':
+    # (or pass workers=1 to read the files in the current process)
+    if __name__ == '__main__':
+        # Read json files from DATA_FOLDER, and flatten each file
+        # Take the file names as IDs while ignoring the file extensions
+        col_names, data = load_json_folder(DATA_FOLDER, extension='.txt')
 
-    # Write to csv (in wide format)
-    list2csv(data, 'data.csv', col_names)
+        # Or, to cache the flattened files so they are only parsed again when they change:
+        # with JsonCache('json_cache/') as cache:
+        #     data = [flatten_json(DATA_FOLDER + datafile, obj_id=datafile[:-4], multiple_obj=True, cache=cache)
+        #             for datafile in os.listdir(DATA_FOLDER)]
+        # col_names, data = fill_missing_keys(data)
 
-    # Convert to long format while removing some unnecessary columns
-    skipping = range(1, 101) + range(2696, 2700)
-    long_cols, long_data = cut_and_stack(col_names, data, cut_start=4, cut_length=9, cut_number=88, skipping)
+        # Write to csv (in wide format)
+        list2csv(data, 'data.csv', col_names)
 
-    # Write to csv (in long format)
-    list2csv(long_data, 'long_data.csv', long_cols)
+        # Convert to long format while removing some unnecessary columns,
+        # and write to csv (in long format) while the long format rows are generated
+        skipping = list(range(1, 101)) + list(range(2696, 2700))
+        long_cols, long_rows = iter_cut_and_stack(col_names, data, cut_start=4, cut_length=9, cut_number=88,
+                                                  skip_cols=skipping)
+        list2csv(long_rows, 'long_data.csv', long_cols)
 """
 
 
+import os
+import io
+import mmap
+import array
+import sys
+import time
+import gzip
+import shutil
+import queue
 import pickle
+import hashlib
+import itertools
+import tempfile
+import threading
+import collections
+import concurrent.futures
 import yaml
 import csv
+import json
+try:  # optional faster json backend
+    import orjson as fast_json
+except ImportError:
+    fast_json = None
+try:  # optional, for faster wide to long conversion
+    import numpy as np
+except ImportError:
+    np = None
+
+
+CSV_CHUNK_ROWS = 10000  # number of rows to format at once when writing csv files
+DISK_TABLE_MEMORY_BUDGET = 2 ** 28  # default number of bytes of rows to keep in memory for DiskTable
+
+
+def _parse_json(text):
+    """
+    Parse a json string (or bytes) with the fastest available json decoder,
+    falling back to yaml for strings that are not strict json
+    """
+    try:
+        if fast_json is not None:
+            return fast_json.loads(text)
+        return json.loads(text)
+    except ValueError:
+        return yaml.safe_load(text)
+
+
+def iter_json(json_file, chunk_size=None):
+    """
+    Lazily read a json file that contains one json object per line.
+    Blank lines are ignored.
+    :param json_file: string file name
+    :param chunk_size: (integer) if None, yield one python object at a time;
+                       otherwise yield lists of (at most) chunk_size python objects
+    :return: a generator of python objects (or lists of python objects)
+    """
+    with open(json_file, 'rb') as infile:
+        chunk = []
+        for line in infile:
+            if not line.strip():
+                continue
+            obj = _parse_json(line)
+            if chunk_size is None:
+                yield obj
+                continue
+            chunk.append(obj)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def _file_digest(filename):
+    """
+    :return: a (hexadecimal string) hash of the contents of a file
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    with open(filename, 'rb') as infile:
+        for block in iter(lambda: infile.read(2 ** 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class JsonCache(object):
+    """
+    An on-disk cache of results computed from json files (e.g. by load_json() or flatten_json()).
+    A result is looked up by the content hash of its source file, so renaming or touching a file
+    does not invalidate its entries, while changing its contents does. The hash itself is only
+    recomputed when the path, size or modification time of the file has changed.
+    Results are stored as binary pickle files in cache_dir. When the total size of the stored
+    results exceeds max_bytes, the least recently used results are deleted.
+    Cache hits and misses are counted in the attributes hits and misses.
+    The index of the cache is kept in memory and only written to disk by save(), close() or at the
+    end of a with block, so use the cache as a context manager (or close it) after a batch of fetches.
+    """
+    INDEX_FILE = 'index.pkl'
+
+    def __init__(self, cache_dir, max_bytes=2 ** 30):
+        """
+        :param cache_dir: string path to the cache directory (created if it doesn't exist)
+        :param max_bytes: (integer) size budget of the cache in bytes
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._changed = False
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        try:
+            with open(os.path.join(cache_dir, self.INDEX_FILE), 'rb') as infile:
+                self._files, self._entries = pickle.load(infile)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            self._files = {}  # {absolute path: (size, mtime, content hash)}
+            self._entries = collections.OrderedDict()  # {entry key: size in bytes}, least recent first
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def save(self):
+        """
+        Write the index of the cache to disk, if it has changed since it was last written.
+        """
+        if self._changed:
+            self._save_index()
+            self._changed = False
+
+    def close(self):
+        """
+        Save the index of the cache. The cache can still be used afterwards.
+        """
+        self.save()
 
+    def stats(self):
+        """
+        :return: a dictionary of cache statistics
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries),
+                'bytes': sum(self._entries.values()), 'max_bytes': self.max_bytes}
 
-def load_json(json_file, multiple_obj=False, pkl_file=None):
+    def fetch(self, filename, tag, compute):
+        """
+        Get the cached result of compute() for a file, or call compute() and cache its result.
+        :param filename: string name of the source file
+        :param tag: string that identifies the computation (and its parameters) on the file
+        :param compute: a function with no arguments that computes the result from the file
+        :return: the (cached) result
+        """
+        key = hashlib.sha1((self._file_hash(filename) + tag).encode('utf-8')).hexdigest()
+        entry_file = os.path.join(self.cache_dir, key + '.pkl')
+        if key in self._entries:
+            try:
+                with open(entry_file, 'rb') as infile:
+                    result = pickle.load(infile)
+            except (IOError, OSError, EOFError, pickle.UnpicklingError):
+                del self._entries[key]  # deleted or broken, compute it again
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                self._changed = True
+                return result
+
+        self.misses += 1
+        result = compute()
+        with open(entry_file, 'wb') as outfile:
+            pickle.dump(result, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+        self._entries[key] = os.path.getsize(entry_file)
+        self._evict()
+        self._changed = True
+        return result
+
+    def clear(self):
+        """
+        Delete all cached results.
+        """
+        for key in list(self._entries):
+            self._remove(key)
+        self._files = {}
+        self._save_index()
+        self._changed = False
+
+    def _file_hash(self, filename):
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        known = self._files.get(path)
+        if known is not None and known[:2] == (stat.st_size, stat.st_mtime_ns):
+            return known[2]
+        self._files[path] = (stat.st_size, stat.st_mtime_ns, _file_digest(path))
+        return self._files[path][2]
+
+    def _remove(self, key):
+        del self._entries[key]
+        try:
+            os.remove(os.path.join(self.cache_dir, key + '.pkl'))
+        except OSError:
+            pass
+
+    def _evict(self):
+        total = sum(self._entries.values())
+        while total > self.max_bytes and len(self._entries) > 1:
+            key = next(iter(self._entries))
+            total -= self._entries[key]
+            self._remove(key)
+
+    def _save_index(self):
+        index_file = os.path.join(self.cache_dir, self.INDEX_FILE)
+        with open(index_file + '.tmp', 'wb') as outfile:
+            pickle.dump((self._files, self._entries), outfile, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(index_file + '.tmp', index_file)
+
+
+def load_json(json_file, multiple_obj=False, cache=None):
     """
     Read a json file as a python object (or a list of python objects)
+    Use iter_json() instead if the file is too large to be loaded into memory at once.
     :param json_file: string file name
-    :param pkl_file: (string file name) optionally save the object as a pickle data file
     :param multiple_obj: (boolean) whether the json file contains multiple objects
                          (must have one object per line) or one object total
+    :param cache: an optional JsonCache, so that the file is only parsed once unless it changes
     :return: a python object (if multiple_obj is False) or
              a list of python objects (if multiple_obj is True)
     """
-    with open(json_file, 'r') as infile:
+    def _load():
         if multiple_obj:
-            data = [yaml.safe_load(line) for line in infile]
+            return list(iter_json(json_file))
+        with open(json_file, 'rb') as infile:
+            return _parse_json(infile.read())
+
+    if cache is not None:
+        return cache.fetch(json_file, 'load_json:%r' % multiple_obj, _load)
+    return _load()
+
+
+def flatten_json(json_file, obj_id=None, multiple_obj=False, cache=None):
+    """
+    Read and flatten a json file, i.e. flatten(load_json(json_file, multiple_obj), obj_id),
+    except that the parsed objects are never cached, only the flattened result.
+    :param cache: an optional JsonCache, so that the file is only parsed and flattened once
+                  unless it changes
+    See load_json() and flatten() for other parameters and the return value.
+    """
+    def _load_and_flatten():
+        return flatten(iter_json(json_file) if multiple_obj else load_json(json_file), obj_id)
+
+    if cache is not None:
+        return cache.fetch(json_file, 'flatten_json:%r:%r' % (multiple_obj, obj_id), _load_and_flatten)
+    return _load_and_flatten()
+
+
+class Flattener(object):
+    """
+    Flatten nested lists or dictionaries to one-dimensional lists (see flatten()).
+    Most objects in a data set have the same nested structure ("shape"), so the sorted column
+    names of every shape are computed only once and reused for later objects of the same shape,
+    for which only the values are extracted. Objects are walked iteratively (no recursion).
+    The lists of names returned for objects of the same shape are the same list object,
+    so don't modify them. (This also makes SchemaUnion.add() faster.)
+    Example:
+        flattener = Flattener()
+        data_list = flattener.flatten_many(objects, obj_ids)
+        col_names, data = fill_missing_keys(data_list)
+    """
+    def __init__(self, max_shapes=4096):
+        """
+        :param max_shapes: (integer) maximum number of shapes to remember
+        """
+        self.max_shapes = max_shapes
+        self._shapes = {}  # {(shape signature, has id): (sorted names, value order) or None if not cacheable}
+        self._paths = {}  # {(parent path, key): interned path}
+
+    @staticmethod
+    def _walk(obj):
+        """
+        :return: the shape signature of obj (a tuple), and a list of its non-None leaf values
+        """
+        signature, leaves = [], []
+        add_signature, add_leaf = signature.append, leaves.append
+        stack = [obj]
+        pop, push = stack.pop, stack.extend
+        while stack:
+            x = pop()
+            x_type = type(x)
+            if x_type is dict:
+                add_signature(tuple(x))  # keys
+                children = list(x.values())
+                children.reverse()
+                push(children)
+            elif x_type is list:
+                add_signature(len(x))
+                push(x[::-1])
+            elif x is None:
+                add_signature(None)
+            else:
+                add_signature('')
+                add_leaf(x)
+        return tuple(signature), leaves
+
+    def _leaf_names(self, obj):
+        """
+        :return: a list of the names of non-None leaf values in obj, in the same order as _walk()
+        """
+        paths = self._paths
+        names = []
+        stack = [(obj, '')]
+        while stack:
+            x, path = stack.pop()
+            if type(x) is dict or type(x) is list:
+                keys = list(x) if type(x) is dict else range(len(x))
+                for k in reversed(keys):
+                    child_path = paths.get((path, k))
+                    if child_path is None:
+                        child_path = paths[(path, k)] = path + str(k) + '.'
+                    stack.append((x[k], child_path))
+            elif x is not None:
+                names.append(path[:-1])
+        return names
+
+    def flatten(self, obj, obj_id=None):
+        """
+        Same as flatten(), except that the returned list of names may be shared with other objects.
+        """
+        if hasattr(obj, '__next__'):  # an iterator of objects, e.g. from iter_json()
+            return self._flatten_iterator(obj, obj_id)
+        signature, values = self._walk(obj)
+        if obj_id is not None:
+            values.insert(0, obj_id)
+        key = (signature, obj_id is not None)
+        try:
+            shape = self._shapes[key]
+        except KeyError:
+            names = self._leaf_names(obj)
+            if obj_id is not None:
+                names.insert(0, 'id')
+            shape = None
+            if len(set(names)) == len(names):
+                order = sorted(range(len(names)), key=names.__getitem__)
+                shape = ([sys.intern(names[i]) for i in order], order)
+            if len(self._shapes) >= self.max_shapes:
+                self._shapes.clear()
+                self._paths.clear()
+            self._shapes[key] = shape
         else:
-            data = yaml.safe_load(infile.read())
+            names = None
+        if shape is None:  # duplicated names, sort by values too (same as the old recursive flatten)
+            if names is None:
+                names = self._leaf_names(obj)
+                if obj_id is not None:
+                    names.insert(0, 'id')
+            pairs = sorted(zip(names, values))
+            return [p[0] for p in pairs], [p[1] for p in pairs]
+        sorted_names, order = shape
+        return sorted_names, [values[i] for i in order]
+
+    def _flatten_iterator(self, objs, obj_id=None):
+        """
+        Flatten the objects of an iterator one at a time, as the elements 0, 1, 2, ... of a list,
+        so that only one of them is in memory at once.
+        """
+        names, values = ([], []) if obj_id is None else (['id'], [obj_id])
+        for i, x in enumerate(objs):
+            x_names, x_values = self.flatten(x)
+            prefix = str(i)
+            names.extend([prefix + '.' + name if name else prefix for name in x_names])
+            values.extend(x_values)
+        order = sorted(range(len(names)), key=names.__getitem__)  # stable, so duplicates keep their order
+        return [names[i] for i in order], [values[i] for i in order]
+
+    def flatten_many(self, objs, obj_ids=None):
+        """
+        Flatten a batch of objects.
+        :param objs: an iterable of objects
+        :param obj_ids: an optional iterable of ids corresponding to objs (see flatten())
+        :return: a list of tuples (column_name_list, value_list), which can be passed to fill_missing_keys()
+        """
+        if obj_ids is None:
+            return [self.flatten(obj) for obj in objs]
+        return [self.flatten(obj, obj_id) for obj, obj_id in zip(objs, obj_ids)]
 
-    if pkl_file:
-        with open(pkl_file, 'w') as outfile:
-            pickle.dump(data, outfile)
 
-    return data
+_flattener = Flattener()
 
 
 def flatten(obj, obj_id=None):
     """
     Flatten a nested list or dictionary to a one-dimensional list.
-    :param obj: a dictionary
-    :param obj_id: if not None, a string 'id' will be added to the beginning of the returned list of names,
-                   and this value will be added to the beginning of the returned list of values
-    :return a list of string names, and a list of corresponding values
-    """
-    names, values = ([], []) if obj_id is None else (['id'], [obj_id])
-
-    def _flatten(x, name=''):  # recursion
-        if type(x) is dict:
-            for k in x:
-                _flatten(x[k], name + k + '.')
-        elif type(x) is list:
-            for i, a in enumerate(x):
-                _flatten(a, name + str(i) + '.')
+    Use Flattener.flatten_many() to flatten a large number of objects.
+    :param obj: a dictionary, a list, or an iterable of objects (e.g. from iter_json())
+    :param obj_id: if not None, a string 'id' will be added to the returned list of names,
+                   and this value will be added to the returned list of values
+    :return a list of string names (sorted), and a list of corresponding values
+    """
+    names, values = _flattener.flatten(obj, obj_id)
+    return list(names), values
+
+
+class SchemaUnion(object):
+    """
+    Incrementally align rows that have different sets of columns.
+    Rows can be added one at a time (e.g. as they are read from files), and the set of
+    columns grows as new column names are seen. Each column name is mapped to an index once,
+    and the values of a row are scattered to those indexes, so adding a row costs
+    O(number of columns), and the whole table O(rows x columns).
+    Example:
+        union = SchemaUnion()
+        for names, values in data_list:
+            union.add(names, values)
+        col_names, data = union.table()
+    """
+    def __init__(self, missing=''):
+        """
+        :param missing: value for the missing columns
+        """
+        self.missing = missing
+        self._names = []  # column names in the order they were first seen
+        self._index = {}  # {column name: index in self._names}
+        self._rows = []  # each row has the length of self._names at the time it was added
+        self._last_names = None  # column names of the last added row, and their indexes
+        self._last_indexes = None  # (None if the indexes are 0, 1, 2, ...)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _indexes(self, names):
+        if names is self._last_names:  # rows flattened with the same shape share a list of names
+            return self._last_indexes
+        index = self._index
+        indexes = []
+        for name in names:
+            i = index.get(name)
+            if i is None:
+                i = index[name] = len(self._names)
+                self._names.append(name)
+            indexes.append(i)
+        if indexes == list(range(len(indexes))):
+            indexes = None
+        self._last_names, self._last_indexes = names, indexes
+        return indexes
+
+    def add(self, names, values):
+        """
+        Add a row.
+        :param names: a list of unique column names of the row
+        :param values: a list of values corresponding to names
+        """
+        indexes = self._indexes(names)
+        if indexes is None:
+            row = list(values)
+            row.extend([self.missing] * (len(self._names) - len(row)))
         else:
-            if x is not None:
-                names.append(name[:-1])
-                values.append(x)
+            row = [self.missing] * len(self._names)
+            for i, value in zip(indexes, values):
+                row[i] = value
+        self._rows.append(row)
+
+    def add_rows(self, names, rows):
+        """
+        Add a number of rows that have the same column names.
+        :param names: a list of unique column names of the rows
+        :param rows: an iterable of value lists corresponding to names
+        """
+        for values in rows:
+            self.add(names, values)
+
+    def columns(self):
+        """
+        :return: a sorted list of all column names seen so far
+        """
+        return sorted(self._names)
 
-    _flatten(obj)
-    names, values = zip(*sorted(zip(names, values)))
-    names, values = list(names), list(values)
-    return names, values
+    def iter_rows(self, col_names=None):
+        """
+        Get the rows added so far, padded with missing values.
+        :param col_names: a list of column names to output (default: self.columns())
+                          It may include columns that were never seen.
+        :return: a generator of rows ordered as col_names
+        """
+        if col_names is None:
+            col_names = self.columns()
+        missing = self.missing
+        order = [self._index.get(name, -1) for name in col_names]
+        width = len(self._names)
+        in_order = order == list(range(width))
+        for row in self._rows:
+            if len(row) < width:
+                row.extend([missing] * (width - len(row)))
+            if in_order:
+                yield list(row)
+                continue
+            row.append(missing)  # so index -1 (column never seen) points to a missing value
+            yield [row[i] for i in order]
+            row.pop()
 
+    def table(self, as_table=False):
+        """
+        :param as_table: (boolean) whether to return the values as a ColumnTable
+        :return: a sorted list of all column names, and a 2-dimensional list (or a ColumnTable) of values
+        """
+        col_names = self.columns()
+        if not as_table:
+            return col_names, list(self.iter_rows(col_names))
+        columns = []
+        for name in col_names:  # one column at a time, without making the padded rows
+            i = self._index[name]
+            values = [row[i] if i < len(row) else self.missing for row in self._rows]
+            columns.append(TypedColumn.from_values(values, self.missing))
+        return col_names, ColumnTable(col_names, columns)
 
-def fill_missing_keys(data_list):
+
+def fill_missing_keys(data_list, as_table=False, scratch_dir=None, memory_budget=DISK_TABLE_MEMORY_BUDGET):
     """
     Given a list of data with another list of column names to each row,
     find the union of column names, and make every row of data have an equal length
     by inserting empty strings at the missing columns.
-    Assuming column names are unique and sorted.
-    :param data_list: a list of tuples (column_name_list, value_list)
-    :return a list of complete column names, and a 2-dimensional list of values
-    """
-    name_lists, data = zip(*data_list)
-
-    # get a complete list of unique column names
-    all_names = sorted(list(set(sum(name_lists, []))))
-
-    # fill empty strings
-    for row in range(len(name_lists)):
-        name_i = 0  # name_list iterator
-        data_i = 0  # data[row] iterator
-        for i in range(len(all_names)):  # i: all_names iterator
-            if name_i < len(name_lists[row]):
-                if name_lists[row][name_i] != all_names[i]:
-                    data[row].insert(data_i, '')
-                else:
-                    name_i += 1
-                data_i += 1
-            else:  # missing the last column
-                data[row].append('')
-    return all_names, data
+    Assuming column names are unique.
+    :param data_list: a list (or any iterable) of tuples (column_name_list, value_list)
+    :param as_table: (boolean) whether to return the values as a (compact) ColumnTable
+    :param scratch_dir: string path to a directory; if not None, the values are returned as a DiskTable
+                        in this directory, for data that doesn't fit in memory
+    :param memory_budget: (integer) approximate number of bytes of rows to keep in memory for the DiskTable
+    :return a list of complete (sorted) column names, and a 2-dimensional list (or a ColumnTable or
+            a DiskTable) of values
+    """
+    if scratch_dir is not None:
+        table = DiskTable(scratch_dir=scratch_dir, memory_budget=memory_budget)
+        for names, values in data_list:
+            table.add(names, values)
+        table.flush()
+        return table.col_names, table
+    union = SchemaUnion()
+    for names, values in data_list:
+        union.add(names, values)
+    return union.table(as_table)
+
+
+class TypedColumn(object):
+    """
+    A column of values stored in a compact typed array instead of a list of python objects.
+    The kind of the column is inferred from its values:
+        'bool': all values are booleans (stored as 1 byte each)
+        'int': all values are integers that fit in 64 bits (1 - 8 bytes each, depending on their range)
+        'float': all values are floats (8 bytes each)
+        'category': all values are strings, stored as codes (1 - 4 bytes each) to a list of unique strings
+        'object': anything else, stored as a list
+    Missing values (missing or None) are tracked in a bitmask, and are returned as missing.
+    """
+    __slots__ = ('kind', 'values', 'mask', 'categories', 'missing')
+
+    def __init__(self, kind, values, mask=None, categories=None, missing=''):
+        """
+        :param kind: (string) kind of the column (see above)
+        :param values: an array (or a list, if kind is 'object') of values, or codes if kind is 'category'
+        :param mask: an optional bytearray, bit i is set if value i is missing
+        :param categories: a list of unique strings (if kind is 'category')
+        :param missing: value returned for missing values
+        """
+        self.kind = kind
+        self.values = values
+        self.mask = mask
+        self.categories = categories
+        self.missing = missing
+
+    @classmethod
+    def from_values(cls, values, missing=''):
+        """
+        :param values: a list of values
+        :param missing: missing value (None is always treated as missing too)
+        :return: a TypedColumn of the smallest kind that can represent the values
+        """
+        missing_at, types = [], set()
+        for i, value in enumerate(values):
+            if value is None or (type(value) is type(missing) and value == missing):
+                missing_at.append(i)
+            else:
+                types.add(type(value))
+        mask = None
+        if missing_at:
+            mask = bytearray((len(values) + 7) // 8)
+            values = list(values)
+            for i in missing_at:
+                mask[i >> 3] |= 1 << (i & 7)
+                values[i] = None
+
+        if len(types) == 1 and types <= {bool, int, float}:
+            kind = {bool: 'bool', int: 'int', float: 'float'}[types.pop()]
+            default = {'bool': False, 'int': 0, 'float': 0.}[kind]
+            if mask is not None:
+                values = [default if value is None else value for value in values]
+            if kind == 'int':
+                low, high = min(values), max(values)
+                typecode = next((code for code in ('b', 'h', 'i', 'q')
+                                 if -2 ** (8 * array.array(code).itemsize - 1) <= low
+                                 and high < 2 ** (8 * array.array(code).itemsize - 1)), None)
+                if typecode is not None:  # otherwise larger than 64 bits
+                    return cls(kind, array.array(typecode, values), mask, missing=missing)
+            else:
+                return cls(kind, array.array('b' if kind == 'bool' else 'd', values), mask, missing=missing)
+        elif types == {str}:
+            index = {}
+            codes = [0 if value is None else index.setdefault(value, len(index)) for value in values]
+            typecode = 'B' if len(index) <= 2 ** 8 else 'H' if len(index) <= 2 ** 16 else 'I'
+            return cls('category', array.array(typecode, codes), mask, list(index), missing)
+        elif not types:  # all missing (or empty)
+            return cls('bool', array.array('b', bytes(len(values))), mask, missing=missing)
+        return cls('object', list(values), mask, missing=missing)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, i):
+        if self.mask is not None and self.mask[i >> 3] >> (i & 7) & 1:
+            return self.missing
+        if self.kind == 'bool':
+            return bool(self.values[i])
+        if self.kind == 'category':
+            return self.categories[self.values[i]]
+        return self.values[i]
+
+    def tolist(self, start=0, stop=None):
+        """
+        :return: a list of the values (from start to stop)
+        """
+        stop = len(self.values) if stop is None else min(stop, len(self.values))
+        values = self.values[start:stop]
+        if self.kind == 'bool':
+            values = [value != 0 for value in values]
+        elif self.kind == 'category':
+            categories = self.categories
+            values = [categories[code] for code in values]
+        else:
+            values = list(values)
+        if self.mask is not None:
+            mask, missing = self.mask, self.missing
+            for i in range(start, stop):
+                if mask[i >> 3] >> (i & 7) & 1:
+                    values[i - start] = missing
+        return values
+
+    def nbytes(self):
+        """
+        :return: (approximate) number of bytes used by the column
+        """
+        size = sys.getsizeof(self.values) + (0 if self.mask is None else sys.getsizeof(self.mask))
+        if self.kind == 'object':
+            size += sum(sys.getsizeof(value) for value in self.values)
+        elif self.kind == 'category':
+            size += sys.getsizeof(self.categories) + sum(sys.getsizeof(value) for value in self.categories)
+        return size
+
+
+class ColumnTable(object):
+    """
+    A table of data stored as TypedColumn's, which uses much less memory than a 2-dimensional list.
+    It can be used where a 2-dimensional list of data is expected (e.g. cut_and_stack(), list2csv()):
+    iterating over it gives the rows as lists.
+    Example:
+        col_names, table = fill_missing_keys(data_list, as_table=True)
+        long_cols, long_table = cut_and_stack(col_names, table, cut_start=4, cut_length=9, cut_number=88)
+        list2csv(long_table, 'long_data.csv', long_cols)
+    """
+    ROWS_PER_CHUNK = 4096  # number of rows to convert from columns at once
+
+    def __init__(self, col_names, columns):
+        """
+        :param col_names: a list of column names
+        :param columns: a list of TypedColumn's corresponding to col_names, all with the same length
+        """
+        self.col_names = list(col_names)
+        self.columns = list(columns)
+
+    @classmethod
+    def from_rows(cls, col_names, rows, missing=''):
+        """
+        :param col_names: a list of column names
+        :param rows: a 2-dimensional list of values; each row should have the same length as col_names
+        :param missing: missing value
+        :return: a ColumnTable
+        """
+        rows = rows if isinstance(rows, list) else list(rows)
+        return cls(col_names, [TypedColumn.from_values([row[j] for row in rows], missing)
+                               for j in range(len(col_names))])
+
+    def __len__(self):
+        return len(self.columns[0]) if self.columns else 0
+
+    def __iter__(self):
+        for start in range(0, len(self), self.ROWS_PER_CHUNK):
+            values = [column.tolist(start, start + self.ROWS_PER_CHUNK) for column in self.columns]
+            for row in zip(*values):
+                yield list(row)
+
+    def to_rows(self):
+        """
+        :return: a 2-dimensional list of values
+        """
+        return list(self)
+
+    def column(self, name):
+        """
+        :param name: column name
+        :return: the TypedColumn of the name
+        """
+        return self.columns[self.col_names.index(name)]
+
+    def nbytes(self):
+        """
+        :return: (approximate) number of bytes used by the table
+        """
+        return sum(column.nbytes() for column in self.columns)
+
+
+class DiskTable(object):
+    """
+    A table stored on disk, for data that doesn't fit in memory.
+    Rows are kept in memory until they take about memory_budget bytes, and then written to a
+    scratch directory as a chunk of TypedColumn's, which are memory-mapped when read again.
+    Each chunk has its own columns, so rows with different columns can be added (as in
+    fill_missing_keys()) and the table widens as new columns are seen.
+    A table created with col_names (as in cut_and_stack()) stores its columns by position instead,
+    so its column names don't have to be unique (or strings).
+    It can be used where a 2-dimensional list of data is expected (e.g. cut_and_stack(), list2csv()):
+    iterating over it gives the rows (with all columns), reading one chunk at a time.
+    Delete the scratch files with close() when the table is no longer needed.
+    Example:
+        col_names, table = fill_missing_keys(data_list, scratch_dir='/scratch/')
+        long_cols, long_table = cut_and_stack(col_names, table, cut_start=4, cut_length=9, cut_number=88)
+        list2csv(long_table, 'long_data.csv', long_cols)
+        table.close()
+        long_table.close()
+    """
+    def __init__(self, col_names=None, scratch_dir=None, memory_budget=DISK_TABLE_MEMORY_BUDGET, missing=''):
+        """
+        :param col_names: an optional list of column names, if all rows will be added with append()
+                          (they may have duplicates)
+        :param scratch_dir: string path to a directory for the scratch files (default: system temp directory)
+        :param memory_budget: (integer) approximate number of bytes of rows to keep in memory
+        :param missing: value for the missing columns
+        """
+        self.path = tempfile.mkdtemp(prefix='disk_table_', dir=scratch_dir)
+        self.memory_budget = memory_budget
+        self.missing = missing
+        self._fixed_cols = None if col_names is None else list(col_names)
+        self._all_names = set()  # column names in the chunks on disk
+        self._chunks = []  # file names (without extension) of the chunks
+        self._n_rows = 0
+        self._buffer = self._new_buffer()
+        self._buffer_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self._n_rows
+
+    def _new_buffer(self):
+        return SchemaUnion(self.missing) if self._fixed_cols is None else []
+
+    @property
+    def col_names(self):
+        """
+        The list of column names: as given, or all (sorted) column names seen so far.
+        """
+        if self._fixed_cols is not None:
+            return self._fixed_cols
+        return sorted(self._all_names.union(self._buffer.columns()))
+
+    def add(self, names, values):
+        """
+        Add a row with its own column names (see SchemaUnion.add()),
+        to a table created without col_names.
+        """
+        if self._fixed_cols is not None:
+            raise ValueError('Use append() to add rows to a table with fixed column names.')
+        self._buffer.add(names, values)
+        self._added(len(values))
+
+    def append(self, row):
+        """
+        Add a row, given in the order of the column names given when creating the table.
+        """
+        if self._fixed_cols is None:
+            raise ValueError('Use add() to add rows to a table without fixed column names.')
+        row = list(row)
+        row.extend([self.missing] * (len(self._fixed_cols) - len(row)))
+        self._buffer.append(row)
+        self._added(len(row))
+
+    def _added(self, n_values):
+        self._n_rows += 1
+        self._buffer_bytes += 64 + 40 * n_values  # list + pointers + (possibly) value objects
+        if self._buffer_bytes >= self.memory_budget:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the rows in memory to disk.
+        """
+        if not len(self._buffer):
+            return
+        if self._fixed_cols is None:
+            col_names, table = self._buffer.table(as_table=True)
+            self._all_names.update(col_names)
+        else:  # by position, not by name
+            col_names = self._fixed_cols
+            table = ColumnTable.from_rows(col_names, self._buffer, self.missing)
+        self._buffer, self._buffer_bytes = self._new_buffer(), 0
+
+        name = os.path.join(self.path, 'chunk-%06d' % len(self._chunks))
+        columns, offset = [], 0
+        with open(name + '.bin', 'wb') as outfile:
+            for column in table.columns:
+                if column.kind == 'object':  # stored in the .meta file
+                    columns.append((column.kind, None, 0, column.mask, None, column.values))
+                    continue
+                data = column.values.tobytes()
+                padding = -len(data) % 8  # keep the columns aligned
+                outfile.write(data + b'\0' * padding)
+                columns.append((column.kind, column.values.typecode, offset, column.mask, column.categories, None))
+                offset += len(data) + padding
+        with open(name + '.meta', 'wb') as outfile:
+            pickle.dump({'col_names': col_names, 'n_rows': len(table), 'columns': columns}, outfile,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        self._chunks.append(name)
+
+    def _read_chunk(self, name):
+        """
+        :return: a list of column names of the chunk, and a ColumnTable backed by memory-mapped arrays
+        """
+        with open(name + '.meta', 'rb') as infile:
+            meta = pickle.load(infile)
+        view = None
+        if os.path.getsize(name + '.bin'):
+            with open(name + '.bin', 'rb') as infile:
+                view = memoryview(mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ))
+        columns = []
+        for kind, typecode, offset, mask, categories, values in meta['columns']:
+            if values is None:
+                size = array.array(typecode).itemsize * meta['n_rows']
+                values = view[offset:offset + size].cast(typecode) if size else array.array(typecode)
+            columns.append(TypedColumn(kind, values, mask, categories, self.missing))
+        return meta['col_names'], ColumnTable(meta['col_names'], columns)
+
+    def iter_chunks(self):
+        """
+        :return: a generator of ColumnTable's, one chunk at a time, with only the columns in that chunk
+        """
+        self.flush()
+        for name in self._chunks:
+            yield self._read_chunk(name)[1]
+
+    def __iter__(self):
+        col_names = self.col_names
+        for table in self.iter_chunks():
+            rows = table if self._fixed_cols is not None else _align_rows(table, table.col_names, col_names,
+                                                                          self.missing)
+            for row in rows:
+                yield row
+
+    def close(self):
+        """
+        Delete the scratch files.
+        """
+        shutil.rmtree(self.path, ignore_errors=True)
+        self._chunks = []
+
+
+def _flatten_files(task):
+    """
+    Read and flatten a number of json files (in a worker process of flatten_json_files()).
+    :param task: a tuple (list of file names, list of ids, multiple_obj)
+    :return: a partial schema, i.e. a list of column names in these files,
+             and a 2-dimensional list of values aligned to them
+    """
+    filenames, obj_ids, multiple_obj = task
+    flattener, union = Flattener(), SchemaUnion()
+    for filename, obj_id in zip(filenames, obj_ids):
+        union.add(*flattener.flatten(iter_json(filename) if multiple_obj else load_json(filename), obj_id))
+    return union.table()
+
+
+def flatten_json_files(filenames, obj_ids=None, multiple_obj=False, workers=None, files_per_task=None,
+                       as_table=False):
+    """
+    Read and flatten a list of json files in parallel, and fill the missing keys, i.e. the same as
+        fill_missing_keys([flatten_json(f, obj_id, multiple_obj) for f, obj_id in zip(filenames, obj_ids)])
+    Each worker process reads and flattens a number of files and returns their partial schema,
+    which are merged in the end.
+    Worker processes may import the calling script again (see Example 2 at the top of this file),
+    so call this function (and load_json_folder() and update_folder_csv()) from a script only
+    under if __name__ == '__main__':, or with workers=1.
+    :param filenames: a list of json file names
+    :param obj_ids: an optional list of ids corresponding to filenames (see flatten())
+    :param multiple_obj: (boolean) whether each json file contains multiple objects (one object per line)
+    :param workers: (integer) number of worker processes (default: number of CPUs; 1: no worker processes)
+    :param files_per_task: (integer) number of files sent to a worker at once
+                           (default: so that each worker gets about 4 tasks)
+    :param as_table: (boolean) whether to return the values as a (compact) ColumnTable
+    :return: a list of complete (sorted) column names, and a 2-dimensional list (or a ColumnTable)
+             of values, one row per file in the same order as filenames
+    """
+    filenames = list(filenames)
+    obj_ids = [None] * len(filenames) if obj_ids is None else list(obj_ids)
+    workers = workers or os.cpu_count() or 1
+    if files_per_task is None:
+        files_per_task = max(1, -(-len(filenames) // (workers * 4)))  # ceiling division
+    tasks = [(filenames[i:i + files_per_task], obj_ids[i:i + files_per_task], multiple_obj)
+             for i in range(0, len(filenames), files_per_task)]
+
+    union = SchemaUnion()
+    if workers == 1 or len(tasks) <= 1:
+        for col_names, rows in map(_flatten_files, tasks):
+            union.add_rows(col_names, rows)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            for col_names, rows in executor.map(_flatten_files, tasks):  # results are in order of tasks
+                union.add_rows(col_names, rows)
+    return union.table(as_table)
+
+
+def load_json_folder(folder, extension='.json', multiple_obj=True, workers=None, as_table=False):
+    """
+    Read and flatten all json files in a folder in parallel, taking the file names (without
+    extension) as ids, and fill the missing keys. See flatten_json_files().
+    :param folder: string path to the folder
+    :param extension: (string) only read files that end with this extension
+    :param multiple_obj: (boolean) whether each json file contains multiple objects (one object per line)
+    :param workers: (integer) number of worker processes (default: number of CPUs; 1: no worker processes)
+    :param as_table: (boolean) whether to return the values as a (compact) ColumnTable
+    :return: a list of complete (sorted) column names, and a 2-dimensional list (or a ColumnTable)
+             of values, one row per file, ordered by file name
+    """
+    datafiles = sorted(f for f in os.listdir(folder) if f.endswith(extension))
+    return flatten_json_files([os.path.join(folder, f) for f in datafiles],
+                              obj_ids=[f[:len(f) - len(extension)] for f in datafiles],
+                              multiple_obj=multiple_obj, workers=workers, as_table=as_table)
 
 
 def longest_common_substring(s1, s2):
@@ -162,61 +1027,148 @@ def longest_common_substring(s1, s2):
             return lcs[k:]  # start from the first alphanumeric character
 
 
-def _simple_stack(wide_cols, wide_data, cols, data, start, end, skip_cols, cut_number):
-    for col_i in range(start, end):
-        if col_i not in skip_cols:
-            cols.append(wide_cols[col_i])
-            for row_i, row in enumerate(wide_data):
-                for new_row_i in range(row_i * cut_number, (row_i + 1) * cut_number):
-                    data[new_row_i].append(row[col_i])
+class RepetitionLayout(collections.namedtuple('RepetitionLayout', ['prefix', 'labels', 'cut_start', 'cut_length',
+                                                                     'cut_number', 'skip_cols', 'cut_names'])):
+    """
+    Repeating block structure of the columns, as inferred by detect_repetition().
+    prefix: the column name part before the repetition number, e.g. 'trials' in 'trials.0.rt'
+    labels: a list of repetition numbers (strings), in the same order as the columns
+    cut_names: a list of column names within one repetition, e.g. 'rt' in 'trials.0.rt'
+    cut_start, cut_length, cut_number, skip_cols: parameters for cut_and_stack()
+    """
+    __slots__ = ()
 
+    def cut_kwargs(self):
+        """
+        :return: a dictionary of keyword arguments for cut_and_stack() or iter_cut_and_stack()
+        """
+        return {'cut_start': self.cut_start, 'cut_length': self.cut_length, 'cut_number': self.cut_number,
+                'skip_cols': self.skip_cols, 'cut_names': self.cut_names}
 
-def cut_and_stack(wide_cols, wide_data, cut_start, cut_length, cut_number, skip_cols=()):
+    def describe(self, col_names):
+        """
+        :param col_names: the list of column names that the layout was detected from
+        :return: a readable description of the layout, to check it before converting the data
+        """
+        cut_end = _cut_range(self.cut_start, self.cut_length, self.cut_number, self.skip_cols)[0]
+        lines = ['Repetitions of "%s": %d (%s ... %s)' % (self.prefix, self.cut_number,
+                                                        self.labels[0], self.labels[-1]),
+                 'Columns in each repetition: %d (%s)' % (self.cut_length, ', '.join(self.cut_names)),
+                 'Cut range: columns %d - %d (%s ... %s)' % (self.cut_start, cut_end - 1,
+                                                             col_names[self.cut_start], col_names[cut_end - 1]),
+                 'Skipped columns in cut range: %d' % len(self.skip_cols)]
+        lines.extend('    %d: %s' % (col, col_names[col]) for col in self.skip_cols)
+        return '\n'.join(lines)
+
+
+def detect_repetition(col_names, prefix=None):
     """
-    Converts data from wide to long format.
-    The cut range (cut_start, cut_start + cut_length * cut_number) has to be continuous
-    after columns in skip_cols are excluded.
-    :param wide_cols: (list) original data column names
-    :param wide_data: (2D list) original data; each sublist should have the same length as wide_cols
-    :param cut_start: (integer) the index indicating where the repetition start.
-                      Columns and data will be cut and stacked right before this start index.
-    :param cut_length: (integer) length of each repetition
-    :param cut_number: (integer) number of repetitions
-    :param skip_cols: (a list of integers) column indexes to be excluded.
-    :return: a list of new column names and a list of new data
+    Infer the repeating block structure of flattened column names (e.g. from fill_missing_keys()),
+    i.e. the parameters for cut_and_stack().
+    A column is part of a repetition if its name contains a number, e.g. 'trials.0.rt' or
+    'trials.12.stim.name' ('trials' is the prefix, '0' and '12' are the labels, 'rt' and 'stim.name'
+    are the names within the repetition). The columns of the chosen prefix must be continuous
+    except for other columns in between, which will be skipped. Names that are not in every
+    repetition are skipped too.
+    Example:
+        layout = detect_repetition(col_names)
+        print(layout.describe(col_names))
+        long_cols, long_data = cut_and_stack(col_names, data, **layout.cut_kwargs())
+    :param col_names: a list of column names
+    :param prefix: (string) prefix of the repeating columns; if None, use the prefix with most columns
+    :return: a RepetitionLayout
     """
-    cols = []
-    n_rows = len(wide_data) * cut_number
-    data = [[] for i in range(n_rows)]
-    skip_cols = list(skip_cols)
-    if len(skip_cols) > 0:
-        skip_cols.sort()
-    # get cut_end and a list of skipped columns within the cut range
-    cut_end = cut_start + cut_length * cut_number  # if no column skipped in the cut range
+    # group columns by prefix: {prefix: [(column index, label, name in repetition)]}
+    groups = collections.OrderedDict()
+    for col, name in enumerate(col_names):
+        tokens = name.split('.')
+        for i, token in enumerate(tokens):
+            if token.isdigit():
+                groups.setdefault('.'.join(tokens[:i]), []).append((col, token, '.'.join(tokens[i + 1:])))
+                break
+    if prefix is None:
+        candidates = [p for p in groups if len(set(label for _, label, _ in groups[p])) > 1]
+        if not candidates:
+            raise ValueError('No repeating columns found.')
+        prefix = max(candidates, key=lambda p: len(groups[p]))
+    elif prefix not in groups:
+        raise ValueError('No repeating columns found with prefix "%s".' % prefix)
+    members = groups[prefix]
+
+    # split into repetitions
+    labels, blocks = [], []  # blocks: [[(column index, name in repetition)]]
+    for col, label, name in members:
+        if not labels or labels[-1] != label:
+            labels.append(label)
+            blocks.append([])
+        blocks[-1].append((col, name))
+    if len(set(labels)) != len(labels):
+        raise ValueError('Columns of repetitions in "%s" are not continuous.' % prefix)
+
+    # names within a repetition have to be in every repetition
+    common = set(name for _, name in blocks[0])
+    for block in blocks[1:]:
+        common.intersection_update(name for _, name in block)
+    cut_names = [name for _, name in blocks[0] if name in common]
+    if not cut_names:
+        raise ValueError('No column name is shared by all repetitions of "%s".' % prefix)
+    kept = set()
+    for label, block in zip(labels, blocks):
+        block_names = [name for _, name in block if name in common]
+        if block_names != cut_names:
+            raise ValueError('Columns in repetition %s of "%s" are in a different order.' % (label, prefix))
+        kept.update(col for col, name in block if name in common)
+
+    cut_start, cut_last = members[0][0], members[-1][0]
+    skip_cols = [col for col in range(cut_start, cut_last + 1) if col not in kept]
+    return RepetitionLayout(prefix, labels, cut_start, len(cut_names), len(labels), skip_cols, cut_names)
+
+
+def _cut_range(cut_start, cut_length, cut_number, skip_cols=()):
+    """
+    :return: the end of the cut range for cut_and_stack(), and a sorted list of skipped columns in the cut range
+    """
+    # if no column is skipped in the cut range, cut_end = cut_start + cut_length * cut_number
+    cut_end = cut_start + cut_length * cut_number
     skip_cols_in_cut = []
-    for col in skip_cols:
+    for col in sorted(set(skip_cols)):
         if cut_start <= col < cut_end:
             skip_cols_in_cut.append(col)
             cut_end += 1
-    # columns before cut
-    _simple_stack(wide_cols, wide_data, cols, data, 0, cut_start, skip_cols, cut_number)
-    # cut starts
-    second_cut_start = 0
-    for row_i, row in enumerate(wide_data):
-        skip_i = 0
-        for cut in range(cut_number):
-            for i in range(cut_length):
-                data_row = row_i * cut_number + cut
-                col = cut_start + cut * cut_length + i + skip_i
-                while skip_i < len(skip_cols_in_cut) and col == skip_cols_in_cut[skip_i]:  # skip
-                    skip_i += 1
-                    col += 1
-                if cut == 1 and i == 0:
-                    second_cut_start = col
-                if col < len(row):
-                    data[data_row].append(row[col])
-    # cut ends
+    return cut_end, skip_cols_in_cut
+
+
+def _cut_indexes(n_cols, cut_start, cut_length, cut_number, skip_cols=()):
+    """
+    Get the indexes of the columns to keep for cut_and_stack().
+    See cut_and_stack() for the parameters.
+    :return: a list of column indexes before the cut range, a 2-dimensional list of column indexes
+             in each repetition (cut_number x cut_length), and a list of column indexes after the cut range
+    """
+    skip_set = set(skip_cols)
+    cut_end = _cut_range(cut_start, cut_length, cut_number, skip_set)[0]
+    before = [col for col in range(0, cut_start) if col not in skip_set]
+    in_cut = [col for col in range(cut_start, cut_end) if col not in skip_set]
+    repetitions = [in_cut[cut * cut_length:(cut + 1) * cut_length] for cut in range(cut_number)]
+    after = [col for col in range(cut_end, n_cols) if col not in skip_set]
+    return before, repetitions, after
+
+
+def _cut_names(wide_cols, cut_start, cut_length, cut_number, skip_cols=(), cut_names=None):
+    """
+    Get the column names of the long format data for cut_and_stack().
+    See cut_and_stack() for the parameters.
+    """
+    before, repetitions, after = _cut_indexes(len(wide_cols), cut_start, cut_length, cut_number, skip_cols)
+    cols = [wide_cols[col] for col in before]
+    if cut_names is not None:
+        if len(cut_names) != cut_length:
+            raise ValueError('Number of cut_names (%d) does not equal to cut_length (%d).'
+                             % (len(cut_names), cut_length))
+        return cols + list(cut_names) + [wide_cols[col] for col in after]
     # get column names in cut range
+    skip_cols_in_cut = _cut_range(cut_start, cut_length, cut_number, skip_cols)[1]
+    second_cut_start = repetitions[1][0] if cut_number > 1 and cut_length > 0 else 0
     i, j, col_counter, skip_i, skip_j = cut_start, second_cut_start, 0, 0, 0
     while skip_j < len(skip_cols_in_cut) and skip_cols_in_cut[skip_j] < second_cut_start:
         skip_j += 1
@@ -233,18 +1185,427 @@ def cut_and_stack(wide_cols, wide_data, cut_start, cut_length, cut_number, skip_
         col_counter += 1
         i += 1
         j += 1
-    # columns after cut
-    _simple_stack(wide_cols, wide_data, cols, data, cut_end, len(wide_cols), skip_cols, cut_number)
+    cols.extend(wide_cols[col] for col in after)
+    return cols
+
+
+def _iter_stacked_rows(wide_rows, before, repetitions, after):
+    """
+    Convert data from wide to long format row by row, given the column indexes from _cut_indexes().
+    Rows that are shorter than the cut range give shorter long format rows.
+    :return: a generator of long format rows
+    """
+    for row in wide_rows:
+        fixed_before = [row[col] for col in before]
+        fixed_after = [row[col] for col in after]
+        row_len = len(row)
+        for rep in repetitions:
+            new_row = list(fixed_before)
+            if rep and rep[-1] < row_len:
+                new_row.extend([row[col] for col in rep])
+            else:
+                new_row.extend([row[col] for col in rep if col < row_len])
+            new_row.extend(fixed_after)
+            yield new_row
+
+
+def _stack_array(wide_data, before, repetitions, after):
+    """
+    Same as list(_iter_stacked_rows()), using NumPy fancy indexing.
+    All rows of wide_data must have the same length, and all column indexes must be within the rows.
+    """
+    wide = np.empty((len(wide_data), len(wide_data[0])), dtype=object)
+    wide[:] = wide_data
+    n_rows, cut_number = len(wide_data), len(repetitions)
+    cut_length = len(repetitions[0]) if cut_number else 0
+    n_before, n_after = len(before), len(after)
+    long = np.empty((n_rows * cut_number, n_before + cut_length + n_after), dtype=object)
+    long[:, :n_before] = np.repeat(wide[:, before], cut_number, axis=0)
+    if cut_length:
+        # (n_rows, cut_number, cut_length) -> one row per repetition
+        long[:, n_before:n_before + cut_length] = \
+            wide[:, np.array(repetitions, dtype=np.intp)].reshape(n_rows * cut_number, cut_length)
+    long[:, n_before + cut_length:] = np.repeat(wide[:, after], cut_number, axis=0)
+    return long.tolist()
+
+
+def _stack_table(table, long_cols, before, repetitions, after):
+    """
+    Same as list(_iter_stacked_rows()) for a ColumnTable, one column at a time.
+    :return: a ColumnTable
+    """
+    cut_number = len(repetitions)
+    columns = []
+    for col in before:
+        values = table.columns[col].tolist()
+        columns.append(TypedColumn.from_values([value for value in values for _ in range(cut_number)]))
+    for i in range(len(repetitions[0]) if cut_number else 0):
+        values = [table.columns[rep[i]].tolist() for rep in repetitions]
+        columns.append(TypedColumn.from_values([value for row in zip(*values) for value in row]))
+    for col in after:
+        values = table.columns[col].tolist()
+        columns.append(TypedColumn.from_values([value for value in values for _ in range(cut_number)]))
+    return ColumnTable(long_cols, columns)
+
+
+def cut_and_stack(wide_cols, wide_data, cut_start, cut_length, cut_number, skip_cols=(), cut_names=None):
+    """
+    Converts data from wide to long format.
+    The cut range (cut_start, cut_start + cut_length * cut_number) has to be continuous
+    after columns in skip_cols are excluded.
+    If NumPy is installed, the data is reshaped with array indexing instead of Python loops.
+    :param wide_cols: (list) original data column names
+    :param wide_data: (2D list, ColumnTable or DiskTable) original data;
+                      each sublist should have the same length as wide_cols
+    :param cut_start: (integer) the index indicating where the repetition start.
+                      Columns and data will be cut and stacked right before this start index.
+    :param cut_length: (integer) length of each repetition
+    :param cut_number: (integer) number of repetitions
+    :param skip_cols: (a list of integers) column indexes to be excluded.
+    :param cut_names: (a list of strings) optional column names for the cut range.
+                      If None, the names are the longest common substrings of the column names
+                      in the first two repetitions.
+    Instead of working out cut_start, cut_length, cut_number, skip_cols and cut_names by hand,
+    you can use detect_repetition(), e.g. cut_and_stack(wide_cols, wide_data, **layout.cut_kwargs())
+    :return: a list of new column names and a list of new data
+             (a ColumnTable or DiskTable if wide_data is a ColumnTable or DiskTable)
+    """
+    skip_cols = list(skip_cols)
+    cols = _cut_names(wide_cols, cut_start, cut_length, cut_number, skip_cols, cut_names)
+    before, repetitions, after = _cut_indexes(len(wide_cols), cut_start, cut_length, cut_number, skip_cols)
+    if isinstance(wide_data, ColumnTable):
+        return cols, _stack_table(wide_data, cols, before, repetitions, after)
+    if isinstance(wide_data, DiskTable):  # one wide row at a time
+        long_table = DiskTable(cols, os.path.dirname(wide_data.path), wide_data.memory_budget, wide_data.missing)
+        for row in _iter_stacked_rows(wide_data, before, repetitions, after):
+            long_table.append(row)
+        long_table.flush()
+        return cols, long_table
+    wide_data = wide_data if isinstance(wide_data, list) else list(wide_data)
+    max_col = max(before + after + [col for rep in repetitions for col in rep] + [-1])
+    if np is not None and wide_data and max_col < len(wide_data[0]) \
+            and all(len(row) == len(wide_data[0]) for row in wide_data):
+        data = _stack_array(wide_data, before, repetitions, after)
+    else:
+        data = list(_iter_stacked_rows(wide_data, before, repetitions, after))
     return cols, data
 
 
-def list2csv(data, csv_filename, col_names=None, delimiter=','):
+def iter_cut_and_stack(wide_cols, wide_rows, cut_start, cut_length, cut_number, skip_cols=(), cut_names=None):
+    """
+    Same as cut_and_stack(), except that the long format rows are generated lazily,
+    one wide format row at a time, so the long format data never has to be in memory.
+    Example:
+        long_cols, long_rows = iter_cut_and_stack(col_names, wide_rows, cut_start=4, cut_length=9, cut_number=88)
+        list2csv(long_rows, 'long_data.csv', long_cols)
+    :param wide_rows: an iterable (e.g. a generator) of rows of the original data
+    See cut_and_stack() for other parameters.
+    :return: a list of new column names and a generator of new rows
+    """
+    skip_cols = list(skip_cols)
+    cols = _cut_names(wide_cols, cut_start, cut_length, cut_number, skip_cols, cut_names)
+    before, repetitions, after = _cut_indexes(len(wide_cols), cut_start, cut_length, cut_number, skip_cols)
+    return cols, _iter_stacked_rows(wide_rows, before, repetitions, after)
+
+
+def pivot_wide(long_cols, long_data, value_cols, id_col='id', rep_col=None, prefix='', rep_labels=None):
+    """
+    Converts data from long to wide format, i.e. the inverse of cut_and_stack().
+    Rows with the same id become one row, in which the values of value_cols in each repetition
+    are in columns named as by flatten(), e.g. 'trials.0.rt' (prefix 'trials', repetition '0',
+    value column 'rt'). The other columns are taken from the first row of each id. The wide columns
+    are the other columns before value_cols, then the repetitions, then the other columns after.
+    Example (given the wide format data in col_names and data):
+        layout = detect_repetition(col_names)
+        long_cols, long_data = cut_and_stack(col_names, data, **layout.cut_kwargs())
+        wide_cols, wide_data = pivot_wide(long_cols, long_data, layout.cut_names,
+                                          prefix=layout.prefix, rep_labels=layout.labels)
+        # wide_cols and wide_data are the same as col_names and data, except for layout.skip_cols
+    :param long_cols: (list) long format column names
+    :param long_data: (2D list, or any iterable of rows) long format data
+    :param value_cols: (list) names of the columns that have different values in each repetition
+    :param id_col: (string) name of the column that identifies a row in wide format
+    :param rep_col: (string) name of the column of repetitions (e.g. trial numbers), which is removed.
+                    If None, the rows of each id are repetitions 0, 1, 2, ... in their order in long_data.
+    :param prefix: (string) prefix of the new column names
+    :param rep_labels: an optional list of repetition labels (strings) in wide format, in order.
+                       If rep_col is None, repetition i is labeled rep_labels[i];
+                       otherwise, the values of rep_col (as strings) are ordered as rep_labels.
+                       If None, repetitions are ordered by when they first appear in long_data.
+    :return: a list of new column names and a list of new data
+    """
+    col_index = {name: i for i, name in enumerate(long_cols)}
+    val_idx = [col_index[name] for name in value_cols]
+    id_i = col_index[id_col]
+    rep_i = None if rep_col is None else col_index[rep_col]
+    first_val = min(val_idx) if val_idx else len(long_cols)
+    fixed = set(val_idx) | ({rep_i} if rep_i is not None else set())
+    before = [i for i in range(first_val) if i not in fixed]
+    after = [i for i in range(first_val, len(long_cols)) if i not in fixed]
+
+    # one pass to index (id, repetition) of every row
+    rows = long_data if isinstance(long_data, list) else list(long_data)
+    id_index, rep_index, counts = {}, {}, {}
+    if rep_labels is not None:
+        rep_index = {str(label): i for i, label in enumerate(rep_labels)}
+    id_pos, rep_pos, first_rows = [], [], []
+    for row_i, row in enumerate(rows):
+        row_id = row[id_i]
+        pos = id_index.get(row_id)
+        if pos is None:
+            pos = id_index[row_id] = len(id_index)
+            first_rows.append(row_i)
+        id_pos.append(pos)
+        if rep_i is None:
+            rep = counts.get(row_id, 0)
+            counts[row_id] = rep + 1
+            if rep_labels is None and rep == len(rep_index):
+                rep_index[str(rep)] = rep
+        else:
+            label = str(row[rep_i])
+            rep = rep_index.get(label)
+            if rep is None:
+                if rep_labels is not None:
+                    raise ValueError('Repetition "%s" is not in rep_labels.' % label)
+                rep = rep_index[label] = len(rep_index)
+        rep_pos.append(rep)
+    labels = sorted(rep_index, key=rep_index.get)
+    if rep_i is None and rep_labels is not None and counts and max(counts.values()) > len(labels):
+        raise ValueError('Some ids have more rows than rep_labels.')
+
+    n_ids, n_reps, n_vals = len(id_index), len(labels), len(val_idx)
+    wide_cols = [long_cols[i] for i in before] + \
+                [(prefix + '.' if prefix else '') + label + '.' + long_cols[i] for label in labels for i in val_idx] + \
+                [long_cols[i] for i in after]
+    if np is not None and rows and all(len(row) == len(long_cols) for row in rows):
+        long = np.empty((len(rows), len(long_cols)), dtype=object)
+        long[:] = rows
+        first = long[first_rows]
+        values = np.full((n_ids, n_reps, n_vals), '', dtype=object)
+        values[np.array(id_pos, dtype=np.intp), np.array(rep_pos, dtype=np.intp)] = long[:, val_idx]
+        wide = np.hstack([first[:, before], values.reshape(n_ids, n_reps * n_vals), first[:, after]])
+        return wide_cols, wide.tolist()
+
+    wide_data = []
+    for row_i in first_rows:
+        row = rows[row_i]
+        wide_data.append([row[i] for i in before] + [''] * (n_reps * n_vals) + [row[i] for i in after])
+    start = len(before)
+    for row, pos, rep in zip(rows, id_pos, rep_pos):
+        offset = start + rep * n_vals
+        wide_data[pos][offset:offset + n_vals] = [row[i] for i in val_idx]
+    return wide_cols, wide_data
+
+
+def _is_gzip_name(filename):
+    """
+    Whether a file name (a string, bytes or path object, or a file descriptor) ends with '.gz'.
+    """
+    return not isinstance(filename, int) and os.fsdecode(filename).endswith('.gz')
+
+
+def _write_chunks(chunks, outfile, errors):
+    """
+    Write byte strings from a queue to a file until None is received (run in a background thread).
+    """
+    while True:
+        chunk = chunks.get()
+        if chunk is None:
+            break
+        if not errors:  # after an error, keep emptying the queue so the producer doesn't block
+            try:
+                outfile.write(chunk)
+            except Exception as err:
+                errors.append(err)
+
+
+def list2csv(data, csv_filename, col_names=None, delimiter=',', compress=None,
+             chunk_rows=CSV_CHUNK_ROWS, lineterminator='\r\n', append=False):
     """
     Write a 2-dimensional data list to a csv file.
+    Rows are written in chunks of chunk_rows. If the file is compressed, each chunk is compressed
+    and written in a background thread while the next chunk is formatted (or generated, if data
+    is a generator).
+    :param data: a 2-dimensional list, a ColumnTable, or any iterable of rows (e.g. a generator)
+    :param csv_filename: file name (a string or a path object, e.g. pathlib.Path)
+    :param col_names: an optional list of column names (if None and data is a ColumnTable or
+                      DiskTable, use its column names)
+    :param delimiter: (string) delimiter between columns
+    :param compress: (boolean) whether to compress the file with gzip.
+                     If None, compress if csv_filename ends with '.gz'.
+    :param chunk_rows: (integer) number of rows per chunk
+    :param lineterminator: (string) string at the end of each row
+    :param append: (boolean) whether to append the rows to an existing file instead of overwriting it
+    :return: a dictionary of the number of rows written (excluding the header), the time it took
+             in seconds, and the number of rows written per second
+    """
+    start_time = time.time()
+    if col_names is None and isinstance(data, (ColumnTable, DiskTable)):
+        col_names = data.col_names
+    if compress is None:
+        compress = _is_gzip_name(csv_filename)
+    if compress:
+        outfile = gzip.open(csv_filename, 'ab' if append else 'wb', compresslevel=6)
+        buf = io.StringIO()
+        chunks, errors = queue.Queue(maxsize=4), []
+        thread = threading.Thread(target=_write_chunks, args=(chunks, outfile, errors))
+        thread.daemon = True
+        thread.start()
+    else:
+        outfile = buf = open(csv_filename, 'a' if append else 'w', newline='', encoding='utf-8',
+                             buffering=2 ** 20)
+        errors = []
+    writer = csv.writer(buf, delimiter=delimiter, lineterminator=lineterminator)
+    if col_names:
+        writer.writerow(col_names)
+
+    n_rows = 0
+    try:
+        rows = iter(data)
+        while not errors:
+            chunk = list(itertools.islice(rows, chunk_rows))
+            writer.writerows(chunk)
+            n_rows += len(chunk)
+            if compress:
+                chunks.put(buf.getvalue().encode('utf-8'))
+                buf.seek(0)
+                buf.truncate()
+            if len(chunk) < chunk_rows:
+                break
+    finally:
+        if compress:
+            chunks.put(None)
+            thread.join()
+        outfile.close()
+    if errors:
+        raise errors[0]
+
+    seconds = time.time() - start_time
+    return {'rows': n_rows, 'seconds': seconds, 'rows_per_sec': n_rows / seconds if seconds > 0 else float('inf')}
+
+
+def list2tsv(data, tsv_filename, col_names=None, missing='n/a', compress=None):
+    """
+    Write a 2-dimensional data list to a tab-separated file as in BIDS (e.g. events.tsv), i.e. with
+    '\n' line endings and missing values (empty strings or None) written as 'n/a'.
+    :param missing: (string) what to write for missing values
+    See list2csv() for other parameters and the return value.
+    """
+    rows = ([missing if v is None or v == '' else v for v in row] for row in data)
+    return list2csv(rows, tsv_filename, col_names, delimiter='\t', compress=compress, lineterminator='\n')
+
+
+def _align_rows(rows, from_cols, to_cols, missing=''):
     """
-    with open(csv_filename, 'w') as outfile:
-        writer = csv.writer(outfile, delimiter=delimiter)
-        if col_names:
-            writer.writerow(col_names)
-        for row in data:
-            writer.writerow(row)
+    Reorder rows with columns from_cols to columns to_cols, filling missing values in new columns.
+    :return: a generator of rows
+    """
+    index = {name: i for i, name in enumerate(from_cols)}
+    order = [index.get(name, -1) for name in to_cols]
+    if order == list(range(len(from_cols))):
+        for row in rows:
+            yield row
+        return
+    for row in rows:
+        row = list(row)
+        row.append(missing)  # so index -1 (new column) points to a missing value
+        yield [row[i] for i in order]
+
+
+def _read_csv_rows(csv_filename):
+    """
+    :return: a generator of rows in a csv file (possibly compressed with gzip)
+    """
+    opener = gzip.open if _is_gzip_name(csv_filename) else open
+    with opener(csv_filename, 'rt', newline='', encoding='utf-8') as infile:
+        for row in csv.reader(infile):
+            yield row
+
+
+def update_folder_csv(folder, csv_filename, extension='.json', multiple_obj=True, manifest_file=None,
+                      workers=None):
+    """
+    Incrementally convert a folder of json files to a wide format csv file, i.e. the same as
+        col_names, data = load_json_folder(folder, extension, multiple_obj)
+        list2csv(data, csv_filename, col_names)
+    except that only files that are new or changed since the last update are read.
+    A manifest of the converted files (size, modification time and content hash) and the columns
+    of the csv file is kept in manifest_file. Rows of new files are appended to the csv file.
+    If new columns appear, or files are changed or removed, the csv file is rewritten once
+    from itself (without reading the other json files again), with the new columns added,
+    and the rows of changed or removed files replaced or dropped.
+    Rows are in order of when their files were converted, not by file name, and columns are never
+    removed (even if the files that had them were changed or removed).
+    :param folder: string path to the folder
+    :param csv_filename: file name of the csv file (a string or a path object)
+    :param extension: (string) only read files that end with this extension
+    :param multiple_obj: (boolean) whether each json file contains multiple objects (one object per line)
+    :param manifest_file: string file name of the manifest (default: csv_filename + '.manifest.json')
+    :param workers: (integer) number of worker processes for reading new files (default: number of CPUs)
+    :return: a dictionary of the numbers of new, changed, removed and unchanged files,
+             and whether the csv file has been rewritten
+    """
+    csv_filename = os.fsdecode(csv_filename)  # also a bytes or pathlib path
+    if manifest_file is None:
+        manifest_file = csv_filename + '.manifest.json'
+    manifest_file = os.fsdecode(manifest_file)
+    manifest = {'columns': [], 'files': {}, 'csv_size': None}
+    if os.path.exists(manifest_file) and os.path.exists(csv_filename):
+        with open(manifest_file, 'r') as infile:
+            manifest = json.load(infile)
+        if manifest['csv_size'] != os.path.getsize(csv_filename):  # e.g. interrupted while writing
+            manifest = {'columns': [], 'files': {}, 'csv_size': None}
+    old_files, old_cols = manifest['files'], manifest['columns']
+
+    # find new and changed files
+    files, new, changed, unchanged = {}, [], [], []
+    for datafile in sorted(f for f in os.listdir(folder) if f.endswith(extension)):
+        if os.path.abspath(os.path.join(folder, datafile)) == os.path.abspath(manifest_file):
+            continue  # the manifest is kept next to the csv file, which may be in the folder
+        stat = os.stat(os.path.join(folder, datafile))
+        known = old_files.get(datafile)
+        if known is not None and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+            files[datafile] = known
+            unchanged.append(datafile)
+            continue
+        digest = _file_digest(os.path.join(folder, datafile))
+        files[datafile] = [stat.st_size, stat.st_mtime_ns, digest]
+        if known is None:
+            new.append(datafile)
+        elif known[2] != digest:
+            changed.append(datafile)
+        else:
+            unchanged.append(datafile)  # touched but not changed
+    removed = [datafile for datafile in old_files if datafile not in files]
+
+    # read new and changed files
+    to_read = new + changed
+    new_cols, new_rows = flatten_json_files([os.path.join(folder, f) for f in to_read],
+                                            obj_ids=[f[:len(f) - len(extension)] for f in to_read],
+                                            multiple_obj=multiple_obj, workers=workers) if to_read else ([], [])
+    all_cols = sorted(set(old_cols).union(new_cols))
+
+    # update csv
+    rewrite = bool(old_cols) and (all_cols != old_cols or bool(changed) or bool(removed))
+    if rewrite:
+        drop_ids = set(f[:len(f) - len(extension)] for f in changed + removed)
+        id_col = old_cols.index('id')
+        old_rows = itertools.islice(_read_csv_rows(csv_filename), 1, None)  # skip the header
+        old_rows = (row for row in old_rows if row[id_col] not in drop_ids)
+        rows = itertools.chain(_align_rows(old_rows, old_cols, all_cols),
+                               _align_rows(new_rows, new_cols, all_cols))
+        temp_filename = csv_filename + '.tmp'
+        list2csv(rows, temp_filename, all_cols, compress=_is_gzip_name(csv_filename))
+        os.replace(temp_filename, csv_filename)
+    elif old_cols:
+        list2csv(_align_rows(new_rows, new_cols, all_cols), csv_filename, append=True)
+    else:
+        list2csv(new_rows, csv_filename, all_cols)
+
+    # update manifest
+    manifest = {'columns': all_cols, 'files': files, 'csv_size': os.path.getsize(csv_filename)}
+    with open(manifest_file + '.tmp', 'w') as outfile:
+        json.dump(manifest, outfile)
+    os.replace(manifest_file + '.tmp', manifest_file)
+    return {'new': len(new), 'changed': len(changed), 'removed': len(removed),
+            'unchanged': len(unchanged), 'rewritten': rewrite}
@@ -12,15 +12,28 @@ This script renames and reorganizes the fMRI data into the Brain Imaging Data St
 It's very rudimentary so you may need to change it (a lot) according to your need.
 
 Usage:
-        python organize_as_BIDS.py <subject_id_1> <subject_id_2> ...
+        python organize_as_BIDS.py [--workers N] <subject_id_1> <subject_id_2> ...
     OR
-        python organize_as_BIDS.py --all
+        python organize_as_BIDS.py [--workers N] --all
+
+Subjects are organized in parallel by N threads (default: WORKERS below), since
+every subject has its own directory. At the end, a summary shows which subjects
+were organized, skipped (nothing changed) or had errors.
+
+For every subject, all renames, moves and json changes are planned first, and the
+plan is checked (e.g. for names used twice and for missing files) before anything
+is changed. With --dry-run, the plans are only printed. Otherwise the plans are
+carried out, and every step is written to a journal (JOURNAL_FILE below, or
+--journal), so that a run that was interrupted can be finished or undone:
+        python organize_as_BIDS.py --resume
+        python organize_as_BIDS.py --rollback [<subject_id_1> <subject_id_2> ...]
 
 It's not thoroughly tested for all cases -- use it with caution, and run a test before you
 use it on your actual files. You can test it by changing the generate_test_files() function
-to generate a file structure similar to yours, then running generate_test_files() followed
-by main() (see the last two lines of this file), and see if there's anything wrong in the
-generated directories/files.
+to generate a file structure similar to yours, then running
+        python organize_as_BIDS.py --generate-test-files 101 102
+which generates the test subjects before organizing them, and see if there's anything wrong
+in the generated directories/files.
 
 This script also assumes that one task has a latin square design made by subject_id % num_runs.
 Change it based on your design.
@@ -28,8 +41,12 @@ Change it based on your design.
 
 from __future__ import print_function
 import os
-import sys
 import re
+import json
+import argparse
+import threading
+import traceback
+import concurrent.futures
 
 
 SUBJECT_DIR_PATH = '../'
@@ -44,6 +61,12 @@ FUNC_NAME_DICT = {  # {current name: (new name, number of runs)}
 ANAT_NAME_DICT = {'MPRAGE_4_min_1X1X1mm': 'T1w'}
 FMAP_NAME_DICT = {'SpinEchoFieldMap_': 'epi'}
 TOTAL_READOUT_TIME = '0.059740927'  # TODO read EffectiveEchoSpacing from file
+WORKERS = 8  # number of subjects organized at the same time
+JOURNAL_FILE = SUBJECT_DIR_PATH + 'organize_as_BIDS_journal.jsonl'
+# all the prefixes above, and a pattern that finds all of them at the start of a name at once
+# (each prefix is in an optional lookahead group, so overlapping prefixes are all found)
+SCAN_PREFIXES = list(FUNC_NAME_DICT) + list(ANAT_NAME_DICT) + list(FMAP_NAME_DICT)
+SCAN_PREFIX_PATTERN = re.compile(''.join('(?=(%s))?' % re.escape(prefix) for prefix in SCAN_PREFIXES))
 
 
 def rename(old_item, new_item):
@@ -51,7 +74,175 @@ def rename(old_item, new_item):
     print('Renamed "%s" to "%s".' % (old_item, new_item))
 
 
-def rename_func_dirs(path, sid, task_prefix, run_num_dict=None, multi_run=True):
+def _normpath(path):
+    return os.path.normpath(os.path.abspath(path))
+
+
+class Plan(object):
+    """
+    A list of operations on files and directories: ['mkdir', path], ['rename', old path, new path] and
+    ['append_json', file name, contents] (see append_to_json()). If immediate, the operations are done
+    as soon as they are added (e.g. when the functions below are used on their own); otherwise they are
+    only planned, to be checked with validate() and done with apply_plan().
+    """
+
+    def __init__(self, immediate=False):
+        self.immediate = immediate
+        self.operations = []
+
+    def mkdir(self, path):
+        if self.immediate:
+            os.makedirs(path)
+        else:
+            self.operations.append(['mkdir', _normpath(path)])
+
+    def rename(self, old_item, new_item):
+        if self.immediate:
+            rename(old_item, new_item)
+        else:
+            self.operations.append(['rename', _normpath(old_item), _normpath(new_item)])
+
+    def append_json(self, filename, contents):
+        if self.immediate:
+            append_to_json(filename, contents)
+        else:
+            self.operations.append(['append_json', _normpath(filename),
+                                    [contents] if type(contents) is str else list(contents)])
+
+    def validate(self, exists=os.path.lexists):
+        """
+        Check the plan without changing anything: every file or directory that is renamed or changed has
+        to exist at that point of the plan, and no name can be used twice.
+        :param exists: a function that tells whether a path exists now (before the plan)
+        :return: a list of error messages (empty if the plan is fine)
+        """
+        def _exists(path, until):
+            # follow path back through the operations before until, to the path it has now
+            for operation in reversed(self.operations[:until]):
+                if operation[0] == 'mkdir' and path == operation[1]:
+                    return True
+                if operation[0] == 'rename':
+                    old, new = operation[1], operation[2]
+                    if path == new or path.startswith(new + os.sep):
+                        path = old + path[len(new):]
+                    elif path == old or path.startswith(old + os.sep):
+                        return False  # moved away
+            return exists(path)
+
+        errors = []
+        for i, operation in enumerate(self.operations):
+            if operation[0] == 'rename':
+                if not _exists(operation[1], i):
+                    errors.append('%s does not exist.' % operation[1])
+                if _exists(operation[2], i):
+                    errors.append('%s already exists.' % operation[2])
+                elif not _exists(os.path.dirname(operation[2]), i):
+                    errors.append('Directory %s does not exist.' % os.path.dirname(operation[2]))
+            elif operation[0] == 'mkdir':
+                if _exists(operation[1], i):
+                    errors.append('%s already exists.' % operation[1])
+                elif not _exists(os.path.dirname(operation[1]), i):
+                    errors.append('Directory %s does not exist.' % os.path.dirname(operation[1]))
+            elif not _exists(operation[1], i):
+                errors.append('%s does not exist.' % operation[1])
+        return errors
+
+    def describe(self):
+        """
+        :return: a list of strings, one per operation
+        """
+        return [_describe(operation) for operation in self.operations]
+
+
+def _describe(operation):
+    if operation[0] == 'mkdir':
+        return 'Make directory "%s".' % operation[1]
+    if operation[0] == 'rename':
+        return 'Rename "%s" to "%s".' % (operation[1], operation[2])
+    return 'Add to "%s": %s' % (operation[1], ''.join(operation[2]).strip())
+
+
+class DirectoryIndex(object):
+    """
+    Index of the scan directories of one subject (directories whose names start with a prefix in
+    FUNC_NAME_DICT, ANAT_NAME_DICT or FMAP_NAME_DICT) and the files in them, read once with os.scandir().
+    The renaming functions below read the index instead of listing the directories again, and rename
+    through it (and its plan) to keep it up to date.
+    """
+
+    def __init__(self, path, plan=None):
+        """
+        :param path: string path to data directory for one subject (ending with '/')
+        :param plan: the Plan that renames are added to (default: renames are done right away)
+        """
+        self.path = path
+        self.plan = plan if plan is not None else Plan(immediate=True)
+        self.by_prefix = {prefix: [] for prefix in SCAN_PREFIXES}  # {prefix: [directory names]}
+        self.files = {}  # {directory name: [file names]}
+        self.names = set()  # all names in path, as they were when scanned
+        with os.scandir(path) as entries:
+            for entry in entries:
+                self.names.add(entry.name)
+                match = SCAN_PREFIX_PATTERN.match(entry.name)
+                prefixes = [SCAN_PREFIXES[i] for i, group in enumerate(match.groups()) if group is not None]
+                if not prefixes or not entry.is_dir():
+                    continue
+                for prefix in prefixes:
+                    self.by_prefix[prefix].append(entry.name)
+                with os.scandir(entry.path) as files:
+                    self.files[entry.name] = [f.name for f in files]
+        for dir_list in self.by_prefix.values():
+            dir_list.sort()
+
+    def exists(self, path):
+        """
+        Whether a path existed when the index was made, without reading the file system again if the path
+        is in the indexed directories (for Plan.validate()).
+        """
+        path = _normpath(path)
+        root = _normpath(self.path)
+        if path.startswith(root + os.sep):
+            parts = path[len(root) + 1:].split(os.sep)
+            if len(parts) == 1:
+                return parts[0] in self.names
+            if len(parts) == 2 and parts[0] in self.files:
+                return parts[1] in self.files[parts[0]]
+        return os.path.lexists(path)
+
+    def dirs(self, prefix):
+        """
+        :param prefix: a prefix in FUNC_NAME_DICT, ANAT_NAME_DICT or FMAP_NAME_DICT
+        :return: a sorted list of the names of the directories that start with prefix
+        """
+        return list(self.by_prefix[prefix])
+
+    def rename_dir(self, old_name, new_name):
+        """
+        Rename a directory in path.
+        """
+        self.plan.rename(self.path + old_name, self.path + new_name)
+        for dir_list in self.by_prefix.values():
+            if old_name in dir_list:
+                dir_list.remove(old_name)
+        self.files[new_name] = self.files.pop(old_name)
+
+    def rename_file(self, folder, old_name, new_name):
+        """
+        Rename a file in a directory in path.
+        """
+        self.plan.rename(self.path + folder + '/' + old_name, self.path + folder + '/' + new_name)
+        files = self.files[folder]
+        files[files.index(old_name)] = new_name
+
+    def move_file(self, folder, filename, destination):
+        """
+        Move a file in a directory in path to destination (a directory path ending with '/').
+        """
+        self.plan.rename(self.path + folder + '/' + filename, destination + filename)
+        self.files[folder].remove(filename)
+
+
+def rename_func_dirs(path, sid, task_prefix, run_num_dict=None, multi_run=True, index=None):
     """
     Rename the folder names in path that start with task_prefix, based on FUNC_NAME_DICT
     Assuming 1) the last number in the folder name indicates the position of this
@@ -65,10 +256,12 @@ def rename_func_dirs(path, sid, task_prefix, run_num_dict=None, multi_run=True):
                          if run # needs to be changed
     :param multi_run: whether the task contains multiple runs (run number 'runX' has to
                       be present in the file name)
+    :param index: the DirectoryIndex of path (read from path if None)
     :return: a dictionary {new_folder_name: old_folder_name}
     """
-    dir_list = [dir_name for dir_name in sorted(os.listdir(path))
-                if dir_name.startswith(task_prefix)]
+    if index is None:
+        index = DirectoryIndex(path)
+    dir_list = index.dirs(task_prefix)
 
     if multi_run:
         dir_list = [d for d in dir_list if 'run' in d]  # TODO this is just for the hierarchy study
@@ -98,66 +291,69 @@ def rename_func_dirs(path, sid, task_prefix, run_num_dict=None, multi_run=True):
             run_num = run_num_dict[run_ids[i]] if run_num_dict is not None else run_ids[i]
             new_name += '_run-' + run_num.zfill(2)
         new_name += '_bold'
-        rename(path + folder, path + new_name)
+        index.rename_dir(folder, new_name)
         folder_dict[new_name] = folder
 
     return folder_dict
 
 
-def rename_anat_dirs(path, sid):
+def rename_anat_dirs(path, sid, index=None):
     """
     Rename the anatomical scan directory based on ANAT_NAME_DICT.
     See rename_func_dirs() for info on parameters and return value.
     """
+    if index is None:
+        index = DirectoryIndex(path)
     folder_dict = {}
     for prefix in ANAT_NAME_DICT:
-        anat_name = None
-        for dir_name in os.listdir(path):
-            if dir_name.startswith(prefix):
-                anat_name = dir_name
-                break
-        if anat_name is None:
+        dir_list = index.dirs(prefix)
+        if not dir_list:
             raise RuntimeError('Anatomical scan not found.')
+        anat_name = dir_list[0]
 
         # renaming
         new_name = 'sub-{}_'.format(sid) + ANAT_NAME_DICT[prefix]
-        rename(path + anat_name, path + new_name)
+        index.rename_dir(anat_name, new_name)
         folder_dict[new_name] = anat_name
     return folder_dict
 
 
-def rename_fmap_dirs(path, sid):
+def rename_fmap_dirs(path, sid, index=None):
     """
     Rename the fieldmap scan directory based on FMAP_NAME_DICT.
     See rename_func_dirs() for info on parameters and return value.
     """
+    if index is None:
+        index = DirectoryIndex(path)
     folder_dict = {}
     for prefix in FMAP_NAME_DICT:
-        dir_list = [dir_name for dir_name in os.listdir(path) if dir_name.startswith(prefix)]
-        for folder in dir_list:
+        for folder in index.dirs(prefix):
             direction = folder[len(prefix):-2]  # -2: assuming fmap is done before the 10th scan... TODO
             new_name = 'sub-{}_dir-{}_'.format(sid, direction) + FMAP_NAME_DICT[prefix]
-            rename(path + folder, path + new_name)
+            index.rename_dir(folder, new_name)
             folder_dict[new_name] = folder
     return folder_dict
 
 
-def rename_files(path, folder_name_dict):
+def rename_files(path, folder_name_dict, index=None):
     """
     Rename all files according to their parent folder name,
     based on folder_name_dict
     :param path: string path to the folders where files need renaming
     :param folder_name_dict: {current_folder_name: old_name}
+    :param index: the DirectoryIndex of path (read from path if None)
     """
+    if index is None:
+        index = DirectoryIndex(path)
     for folder_name in folder_name_dict:
         old_name = folder_name_dict[folder_name]
-        for filename in os.listdir(path + folder_name):
+        for filename in list(index.files[folder_name]):
             if filename.startswith(old_name):
                 new_name = filename.replace(old_name, folder_name, 1)
-                rename(path + folder_name + '/' + filename, path + folder_name + '/' + new_name)
+                index.rename_file(folder_name, filename, new_name)
 
 
-def reorganize_files(subj_dir, sid, dir_list, file_extensions=('.json', '.nii.gz')):
+def reorganize_files(subj_dir, sid, dir_list, file_extensions=('.json', '.nii.gz'), index=None):
     """
     Reorganize files into BIDS (Brain Imaging Data Structure), i.e. move data from functional
     scans, anatomical scans and fieldmaps to sub-<id>/func, sub-<id>/anat, sub-<id>/fmap,
@@ -169,6 +365,8 @@ def reorganize_files(subj_dir, sid, dir_list, file_extensions=('.json', '.nii.gz
     :param dir_list: a list of directory names where the files are (i.e. directories in
                      subj_dir + PATH_BETWEEN_SUBJECT_AND_TASK_DIR)
     :param file_extensions: a list of file extensions that need to be moved
+    :param index: the DirectoryIndex of subj_dir + PATH_BETWEEN_SUBJECT_AND_TASK_DIR (read if None)
+    :return: a dictionary {'/func': [moved file names], '/anat': [...], '/fmap': [...]}
     """
     dir_lists = {'/func': [], '/anat': [], '/fmap': []}
     for folder in dir_list:
@@ -179,15 +377,19 @@ def reorganize_files(subj_dir, sid, dir_list, file_extensions=('.json', '.nii.gz
         elif any(postfix in folder for postfix in FMAP_NAME_DICT.values()):
             dir_lists['/fmap'].append(folder)
 
-    data_path = subj_dir + PATH_BETWEEN_SUBJECT_AND_TASK_DIR + '/'
+    if index is None:
+        index = DirectoryIndex(subj_dir + PATH_BETWEEN_SUBJECT_AND_TASK_DIR + '/')
+    moved_files = {dir_type: [] for dir_type in dir_lists}
     for dir_type in dir_lists:
-        os.makedirs(subj_dir + dir_type)
+        index.plan.mkdir(subj_dir + dir_type)
         for folder in dir_lists[dir_type]:
-            for f in os.listdir(data_path + folder):
-                if any(f == folder + ext for ext in file_extensions):
-                    rename(data_path + folder + '/' + f, subj_dir + dir_type + '/' + f)
+            for f in [folder + ext for ext in file_extensions]:
+                if f in index.files[folder]:
+                    index.move_file(folder, f, subj_dir + dir_type + '/')
+                    moved_files[dir_type].append(f)
 
-    rename(subj_dir, SUBJECT_DIR_PATH + 'sub-' + sid)
+    index.plan.rename(subj_dir, SUBJECT_DIR_PATH + 'sub-' + sid)
+    return moved_files
 
 
 def append_to_json(filename, contents):
@@ -212,39 +414,50 @@ def append_to_json(filename, contents):
         json_file.write(''.join(json_content))
 
 
-def fix_fmap_json(sid, total_readout_time=None):
+def fix_fmap_json(sid, total_readout_time=None, moved_files=None, plan=None):
     """
     Add the "IntendedFor" and optionally "TotalReadoutTime" parameters to the json files for
     fieldmap data so the fieldmaps are intended for all functional scans.
     Assuming the files are already organized as BIDS.
     :parameter sid: string subject id
     :parameter total_readout_time: string or float number, or None if unnecessary
+    :parameter moved_files: the dictionary returned by reorganize_files() (the directories are listed if None)
+    :parameter plan: the Plan that the changes are added to (default: changes are done right away)
     """
+    if plan is None:
+        plan = Plan(immediate=True)
     # get functional scan names
     subject_path = SUBJECT_DIR_PATH + 'sub-%s/' % sid
-    func_names = ['func/' + f for f in os.listdir(subject_path + 'func/') if f.endswith('bold.nii.gz')]
+    func_files = moved_files['/func'] if moved_files is not None else os.listdir(subject_path + 'func/')
+    func_names = ['func/' + f for f in func_files if f.endswith('bold.nii.gz')]
     intended_for = '\t"IntendedFor": ["' + '",\n\t\t"'.join(func_names) + '"\n\t],\n'
 
     # change json
-    json_filenames = [f for f in os.listdir(subject_path + 'fmap/') if f.endswith('json')]
+    fmap_files = moved_files['/fmap'] if moved_files is not None else os.listdir(subject_path + 'fmap/')
+    json_filenames = [f for f in fmap_files if f.endswith('json')]
     for json_name in json_filenames:
         json_name = subject_path + 'fmap/' + json_name
         contents = intended_for if total_readout_time is None \
                    else [intended_for, '\t"TotalReadoutTime": %s\n' % str(total_readout_time)]
-        append_to_json(json_name, contents)
+        plan.append_json(json_name, contents)
 
 
-def fix_func_json(sid):
+def fix_func_json(sid, moved_files=None, plan=None):
     """
     Add the "TaskName" parameter to json files for functional scans.
     Assuming the files are already organized as BIDS.
     :parameter sid: string subject id
+    :parameter moved_files: the dictionary returned by reorganize_files() (the directory is listed if None)
+    :parameter plan: the Plan that the changes are added to (default: changes are done right away)
     """
+    if plan is None:
+        plan = Plan(immediate=True)
     subject_path = SUBJECT_DIR_PATH + 'sub-%s/' % sid
-    json_filenames = [f for f in os.listdir(subject_path + 'func/') if f.endswith('json')]
+    func_files = moved_files['/func'] if moved_files is not None else os.listdir(subject_path + 'func/')
+    json_filenames = [f for f in func_files if f.endswith('json')]
     for json_name in json_filenames:
         task_name = re.search(r'task-\w+_', json_name).group()[5:-1]
-        append_to_json(subject_path + 'func/' + json_name, '\t"TaskName": "%s"\n' % task_name)
+        plan.append_json(subject_path + 'func/' + json_name, '\t"TaskName": "%s"\n' % task_name)
 
 
 def generate_test_files(subject_ids):
@@ -269,7 +482,7 @@ def generate_test_files(subject_ids):
                 with open(run_dir + '/' + run_name + '.json', 'w') as f:
                     f.write('{\n\t"ABC": 123\n}\n')
             # a one-run task
-            run_name = FUNC_NAME_DICT.keys()[2] + '_20'
+            run_name = list(FUNC_NAME_DICT)[2] + '_20'
             run_dir = subject_dir + PATH_BETWEEN_SUBJECT_AND_TASK_DIR + '/' + run_name
             os.makedirs(run_dir)
             for file_postfix in ['.nii.gz', '.json', '_yo.ica', '_sth_else.pdf']:  # arbitrary stuff
@@ -277,7 +490,7 @@ def generate_test_files(subject_ids):
             with open(run_dir + '/' + run_name + '.json', 'w') as f:
                 f.write('{\n\t"ABC": 123\n}\n')
             # anatomical
-            anat_name = ANAT_NAME_DICT.keys()[0] + '_17'
+            anat_name = list(ANAT_NAME_DICT)[0] + '_17'
             anat_dir = subject_dir + PATH_BETWEEN_SUBJECT_AND_TASK_DIR + '/' + anat_name
             os.makedirs(anat_dir)
             for file_postfix in ['.nii.gz', '.json', '_yo.nii.gz', '_sth_else.pdf']:  # arbitrary stuff
@@ -286,7 +499,7 @@ def generate_test_files(subject_ids):
                 f.write('{\n\t"ABC": 123\n}\n')
             # fieldmaps
             for d in ('PA', 'AP'):
-                fmap_name = FMAP_NAME_DICT.keys()[0] + d + '_5'
+                fmap_name = list(FMAP_NAME_DICT)[0] + d + '_5'
                 fmap_dir = subject_dir + PATH_BETWEEN_SUBJECT_AND_TASK_DIR + '/' + fmap_name
                 os.makedirs(fmap_dir)
                 for file_postfix in ['.nii.gz', '.json', '_yo.nii.gz', '_sth_else.pdf']:  # arbitrary stuff
@@ -299,55 +512,349 @@ def generate_test_files(subject_ids):
         return
 
 
-def main():
-    try:
-        if len(sys.argv) < 2:
-            raise RuntimeError()
-        subject_ids = sys.argv[1:]
-        if len(subject_ids) == 1 and subject_ids[0] == '--all':
-            subject_ids = None
-    except RuntimeError:
-        print('Usage:\n\t\tpython organize_as_BIDS.py <subject_id_1> <subject_id_2> ...'
-              '\n\tOR\n\t\tpython organize_as_BIDS.py --all')
-        quit()
-
-    for subj_dir in os.listdir(SUBJECT_DIR_PATH):
-        # TODO iterate through subject_ids instead (and print errors)
-        if not subj_dir.startswith(SUBJECT_DIR_PREFIX):
+class Journal(object):
+    """
+    Append-only journal of the plans that are carried out, one json record per line:
+        {"subject": ..., "plan": [operations]}      before the first operation of a subject
+        {"subject": ..., "before": i, "text": ...}  contents of a json file before operation i changes it
+        {"subject": ..., "done": i}                 after operation i
+        {"subject": ..., "finished": true}          after the last operation
+        {"subject": ..., "undone": i}               after operation i is undone
+        {"subject": ..., "rolled_back": true}       after all operations are undone (not if some could not be)
+    Every record is flushed, so if this script is stopped, at most the operation after the last "done"
+    of a subject may have been done without being recorded (resume and rollback check that operation).
+    Plans and their ends are also synced to the disk.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'a')
+        self.lock = threading.Lock()
+
+    def write(self, record, sync=False):
+        line = json.dumps(record) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+            if sync:
+                os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+    @staticmethod
+    def read(filename):
+        """
+        Read the latest plan of every subject in a journal, and how far it went.
+        :param filename: file name of the journal
+        :return: a dictionary {subject directory name: {'plan': operations, 'done': set of indexes,
+                 'undone': set of indexes, 'before': {index: text}, 'finished': bool, 'rolled_back': bool}}
+        """
+        states = {}
+        with open(filename, 'r') as infile:
+            for line in infile:
+                try:
+                    record = json.loads(line)
+                except ValueError:  # the last line, if this script was stopped while writing it
+                    continue
+                subject = record['subject']
+                if 'plan' in record:
+                    states[subject] = {'plan': record['plan'], 'done': set(), 'undone': set(), 'before': {},
+                                       'finished': False, 'rolled_back': False}
+                    continue
+                state = states[subject]
+                if 'before' in record:
+                    state['before'][record['before']] = record['text']
+                for key in ('done', 'undone'):
+                    if key in record:
+                        state[key].add(record[key])
+                for key in ('finished', 'rolled_back'):
+                    if key in record:
+                        state[key] = True
+        return states
+
+
+def _is_done(operation):
+    """
+    Whether an operation has been done (for the operation that may have been done before a journal was cut).
+    """
+    if operation[0] == 'rename':
+        return not os.path.lexists(operation[1]) and os.path.lexists(operation[2])
+    if operation[0] == 'mkdir':
+        return os.path.isdir(operation[1])
+    with open(operation[1], 'r') as json_file:
+        return ''.join(operation[2]) in json_file.read()
+
+
+def apply_plan(subj_dir, operations, journal=None, done=(), resume=False):
+    """
+    Carry out a plan, recording every operation in the journal.
+    :param subj_dir: name of the subject directory (to identify the plan in the journal)
+    :param operations: Plan.operations
+    :param journal: a Journal, or None
+    :param done: indexes of operations that are already done (when resuming)
+    :param resume: (boolean) whether the plan is in the journal already, from an apply_plan() that stopped;
+                   then the first operation that is not done may have been done without being recorded
+    """
+    def _record(record, sync=False):
+        if journal is not None:
+            record['subject'] = subj_dir
+            journal.write(record, sync)
+
+    if not resume:
+        _record({'plan': operations}, sync=True)
+    check = resume  # the first operation that is not recorded may be done already
+    for i, operation in enumerate(operations):
+        if i in done:
             continue
-        sid = subj_dir[len(SUBJECT_DIR_PREFIX):]
-        if subject_ids is not None and sid not in subject_ids:
+        if check:
+            check = False
+            if _is_done(operation):
+                _record({'done': i})
+                continue
+        if operation[0] == 'mkdir':
+            os.makedirs(operation[1])
+        elif operation[0] == 'rename':
+            rename(operation[1], operation[2])
+        else:
+            with open(operation[1], 'r') as json_file:
+                _record({'before': i, 'text': json_file.read()})
+            append_to_json(operation[1], operation[2])
+        _record({'done': i})
+    _record({'finished': True}, sync=True)
+
+
+def rollback_plan(subj_dir, state, journal=None):
+    """
+    Undo the operations of a plan that have been done, in reverse order.
+    Operations that cannot be undone (e.g. a renamed item is missing, or something else now has its old name)
+    are left as they are; then the plan is not recorded as rolled back, so the rest can be fixed by hand and
+    rolled back again.
+    :param subj_dir: name of the subject directory
+    :param state: the state of the subject from Journal.read()
+    :param journal: a Journal, or None
+    :return: a list of the operations that could not be undone
+    """
+    operations = state['plan']
+    done = set(state['done']) - state['undone']
+    following = max(state['done']) + 1 if state['done'] else 0
+    if following < len(operations) and following not in state['undone'] and _is_done(operations[following]):
+        done.add(following)  # done, but stopped before it was recorded
+    failed = []
+    for i in sorted(done, reverse=True):
+        operation = operations[i]
+        try:
+            if operation[0] == 'mkdir':
+                if os.path.isdir(operation[1]):
+                    os.rmdir(operation[1])
+            elif operation[0] == 'rename':
+                if os.path.lexists(operation[2]) and not os.path.lexists(operation[1]):
+                    rename(operation[2], operation[1])
+                elif os.path.lexists(operation[2]) or not os.path.lexists(operation[1]):  # else undone already
+                    failed.append(operation)
+                    continue
+            elif i in state['before']:
+                with open(operation[1], 'w') as json_file:
+                    json_file.write(state['before'][i])
+            else:
+                failed.append(operation)
+                continue
+        except OSError:  # e.g. a directory that is not empty
+            failed.append(operation)
             continue
+        if journal is not None:
+            journal.write({'subject': subj_dir, 'undone': i})
+    if journal is not None and not failed:
+        journal.write({'subject': subj_dir, 'rolled_back': True}, sync=True)
+    return failed
 
-        num_latin_sq_runs = FUNC_NAME_DICT[LATIN_SQUARE_TASK_PREFIX][1]
-        old_run_nums = [str(i + 1) for i in range(num_latin_sq_runs)]
-        remainder = int(sid) % num_latin_sq_runs
-        new_run_nums = old_run_nums[remainder:] + old_run_nums[:remainder]
-        run_num_dict = {old_run_nums[i]: new_run_nums[i] for i in range(num_latin_sq_runs)}
 
-        path = SUBJECT_DIR_PATH + subj_dir + PATH_BETWEEN_SUBJECT_AND_TASK_DIR + '/'
-        sid = str(sid)
+def plan_subject(subj_dir):
+    """
+    Plan the renames, moves and json changes of one subject, without changing anything.
+    :param subj_dir: name of the subject directory (in SUBJECT_DIR_PATH)
+    :return: a Plan and its DirectoryIndex
+    :raise RuntimeError: if the data of the subject cannot be organized
+    """
+    sid = subj_dir[len(SUBJECT_DIR_PREFIX):]
+    if not os.path.isdir(SUBJECT_DIR_PATH + subj_dir + PATH_BETWEEN_SUBJECT_AND_TASK_DIR):
+        raise RuntimeError('Directory %s not found.' % (subj_dir + PATH_BETWEEN_SUBJECT_AND_TASK_DIR))
+    if os.path.exists(SUBJECT_DIR_PATH + 'sub-' + sid):
+        raise RuntimeError('sub-%s already exists.' % sid)
+
+    num_latin_sq_runs = FUNC_NAME_DICT[LATIN_SQUARE_TASK_PREFIX][1]
+    old_run_nums = [str(i + 1) for i in range(num_latin_sq_runs)]
+    remainder = int(sid) % num_latin_sq_runs
+    new_run_nums = old_run_nums[remainder:] + old_run_nums[:remainder]
+    run_num_dict = {old_run_nums[i]: new_run_nums[i] for i in range(num_latin_sq_runs)}
+
+    path = SUBJECT_DIR_PATH + subj_dir + PATH_BETWEEN_SUBJECT_AND_TASK_DIR + '/'
+    sid = str(sid)
+
+    plan = Plan()
+    index = DirectoryIndex(path, plan)
+    folder_dict = rename_anat_dirs(path, sid, index)
+    folder_dict.update(rename_fmap_dirs(path, sid, index))
+    for task_prefix in FUNC_NAME_DICT:
+        num_runs = FUNC_NAME_DICT[task_prefix][1]
+        run_dict = run_num_dict if task_prefix == LATIN_SQUARE_TASK_PREFIX else None
+        folder_dict.update(rename_func_dirs(path, sid, task_prefix, run_dict, multi_run=(num_runs > 1),
+                                            index=index))
+    rename_files(path, folder_dict, index)
+    moved_files = reorganize_files(SUBJECT_DIR_PATH + subj_dir + '/', sid, folder_dict.keys(), index=index)
+    fix_fmap_json(sid, TOTAL_READOUT_TIME, moved_files, plan)
+    fix_func_json(sid, moved_files, plan)
+    return plan, index
+
+
+def organize_subject(subj_dir, journal=None, dry_run=False):
+    """
+    Rename and reorganize the data of one subject: plan it, check the plan, and carry it out.
+    :param subj_dir: name of the subject directory (in SUBJECT_DIR_PATH)
+    :param journal: a Journal to record the operations in, or None
+    :param dry_run: (boolean) only print the plan
+    :return: (status, message), where status is 'organized', 'planned' (dry run), 'skipped' (nothing changed)
+             or 'error'
+    """
+    try:
+        plan, index = plan_subject(subj_dir)
+    except RuntimeError as err:
+        return 'skipped', str(err)
+    errors = plan.validate(index.exists)
+    if errors:
+        return 'skipped', 'Invalid plan: ' + ' '.join(errors)
+    if dry_run:
+        print('\n'.join(['Plan for %s:' % subj_dir] + ['\t' + line for line in plan.describe()]))
+        return 'planned', '%d operations.' % len(plan.operations)
+    apply_plan(subj_dir, plan.operations, journal)
+    return 'organized', 'Organized as sub-%s.' % subj_dir[len(SUBJECT_DIR_PREFIX):]
+
+
+def _run(function, *args):
+    try:
+        return function(*args)
+    except Exception as err:  # report it with the other subjects instead of stopping the other workers
+        traceback.print_exc()
+        return 'error', '%s: %s' % (type(err).__name__, err)
 
-        folder_dict = {}
-        try:
-            folder_dict = rename_anat_dirs(path, sid)
-            folder_dict.update(rename_fmap_dirs(path, sid))
-            for task_prefix in FUNC_NAME_DICT:
-                num_runs = FUNC_NAME_DICT[task_prefix][1]
-                run_dict = run_num_dict if task_prefix == LATIN_SQUARE_TASK_PREFIX else None
-                folder_dict.update(rename_func_dirs(path, sid, task_prefix, run_dict, multi_run=(num_runs > 1)))
-        except RuntimeError as err:
-            print('Error in %s:' % subj_dir, err, 'Skipping %s.' % subj_dir)
-            # reverse renamed folders
-            for item in folder_dict:
-                rename(path + item, path + folder_dict[item])
-        else:  # no error
-            rename_files(path, folder_dict)
-            reorganize_files(SUBJECT_DIR_PATH + subj_dir + '/', sid, folder_dict.keys())
-            fix_fmap_json(sid, total_readout_time=TOTAL_READOUT_TIME)
-            fix_func_json(sid)
+
+def _run_all(function, subj_dirs, args, workers):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [executor.submit(_run, function, subj_dir, *args) for subj_dir in subj_dirs]
+        return {subj_dir: future.result() for subj_dir, future in zip(subj_dirs, futures)}
+
+
+def organize_subjects(subject_ids=None, workers=WORKERS, journal_file=JOURNAL_FILE, dry_run=False):
+    """
+    Organize subjects in parallel.
+    :param subject_ids: a list of string subject ids, or None for all subjects in SUBJECT_DIR_PATH
+    :param workers: (integer) number of subjects organized at the same time
+    :param journal_file: file name of the journal (appended to)
+    :param dry_run: (boolean) only print the plans
+    :return: a dictionary {subject directory name: (status, message)} (see organize_subject())
+    """
+    if subject_ids is None:
+        subj_dirs = sorted(d for d in os.listdir(SUBJECT_DIR_PATH) if d.startswith(SUBJECT_DIR_PREFIX))
+    else:
+        subj_dirs = [SUBJECT_DIR_PREFIX + str(sid) for sid in subject_ids]
+    journal = None if dry_run else Journal(journal_file)
+    try:
+        return _run_all(organize_subject, subj_dirs, (journal, dry_run), workers)
+    finally:
+        if journal is not None:
+            journal.close()
+
+
+def _resume_subject(subj_dir, state, journal):
+    apply_plan(subj_dir, state['plan'], journal, done=state['done'], resume=True)
+    return 'organized', 'Finished %d remaining operations.' % (len(state['plan']) - len(state['done']))
+
+
+def _rollback_subject(subj_dir, state, journal):
+    failed = rollback_plan(subj_dir, state, journal)
+    if failed:
+        return 'error', 'Could not undo %d operations: %s' % (len(failed), ' '.join(map(_describe, failed)))
+    return 'rolled back', 'Undid the plan.'
+
+
+def resume_subjects(journal_file=JOURNAL_FILE, workers=WORKERS):
+    """
+    Finish the plans in a journal that were interrupted, without planning or scanning the directories again.
+    :return: a dictionary {subject directory name: (status, message)}
+    """
+    states = Journal.read(journal_file)
+    subj_dirs = [d for d in sorted(states)  # a partial rollback has to be finished with rollback_subjects()
+                 if not states[d]['finished'] and not states[d]['rolled_back'] and not states[d]['undone']]
+    journal = Journal(journal_file)
+    try:
+        return _run_all(lambda d, j: _resume_subject(d, states[d], j), subj_dirs, (journal,), workers)
+    finally:
+        journal.close()
+
+
+def rollback_subjects(subject_ids=None, journal_file=JOURNAL_FILE, workers=WORKERS):
+    """
+    Undo the plans in a journal (finished or not).
+    :param subject_ids: a list of string subject ids, or None for all subjects in the journal
+    :return: a dictionary {subject directory name: (status, message)}
+    """
+    states = Journal.read(journal_file)
+    subj_dirs = [d for d in sorted(states) if not states[d]['rolled_back']]
+    if subject_ids is not None:
+        subj_dirs = [d for d in subj_dirs if d[len(SUBJECT_DIR_PREFIX):] in [str(sid) for sid in subject_ids]]
+    journal = Journal(journal_file)
+    try:
+        return _run_all(lambda d, j: _rollback_subject(d, states[d], j), subj_dirs, (journal,), workers)
+    finally:
+        journal.close()
+
+
+def print_summary(results):
+    """
+    Print the results of organize_subjects(), resume_subjects() or rollback_subjects(), grouped by status.
+    """
+    print('\nSummary:')
+    for status in ('organized', 'planned', 'rolled back', 'skipped', 'error'):
+        subj_dirs = [d for d in results if results[d][0] == status]
+        if not subj_dirs and status in ('planned', 'rolled back'):
+            continue
+        print('%d %s' % (len(subj_dirs), status))
+        for subj_dir in subj_dirs:
+            print('\t%s: %s' % (subj_dir, results[subj_dir][1]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rename and reorganize fMRI data into BIDS.')
+    parser.add_argument('subject_ids', nargs='*', help='subject ids')
+    parser.add_argument('--all', action='store_true', help='organize all subjects')
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help='number of subjects organized at the same time (default: %d)' % WORKERS)
+    parser.add_argument('--dry-run', action='store_true', help='only print what would be done')
+    parser.add_argument('--journal', default=JOURNAL_FILE, help='journal file (default: %s)' % JOURNAL_FILE)
+    parser.add_argument('--resume', action='store_true', help='finish the interrupted plans in the journal')
+    parser.add_argument('--rollback', action='store_true',
+                        help='undo the plans in the journal (of the given subjects, or all)')
+    parser.add_argument('--generate-test-files', action='store_true',
+                        help='generate test directories and files for the given subjects first '
+                             '(see generate_test_files())')
+    args = parser.parse_args()
+
+    if args.generate_test_files:
+        if not args.subject_ids:
+            parser.error('Specify the subject ids to generate test files for.')
+        generate_test_files(args.subject_ids)
+
+    if args.resume:
+        results = resume_subjects(args.journal, args.workers)
+    elif args.rollback:
+        results = rollback_subjects(args.subject_ids or None, args.journal, args.workers)
+    else:
+        if not args.all and not args.subject_ids:
+            parser.error('Specify subject ids or --all.')
+        results = organize_subjects(None if args.all else args.subject_ids, args.workers, args.journal,
+                                    args.dry_run)
+    print_summary(results)
 
 
 if __name__ == '__main__':
-    generate_test_files(list(range(101, 103)))
     main()
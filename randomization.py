@@ -7,74 +7,535 @@ itself. For example, when there are 2 types of non-special stimuli (0 and 1),
 the special stimulus 2 would appear X times after 0, X times after 1, and X
 times after 2.
 
+The number of each ordinary stimulus type per block has to be a multiple of
+(the number of ordinary stimulus types + 1).
+
+Use generate_blocks() to generate many blocks at once, e.g.
+    blocks = generate_blocks(num_blocks=30, num_types=2, num_per_type=6, seed=1234)
+gives a (30 x 24) integer array, one block per row, where the ordinary stimuli
+are 0 and 1 and the special stimulus is 2. The same seed always gives the same
+blocks.
+
+For other designs, eulerian_sequence() constructs a random sequence with any
+given number of times that each stimulus type follows each stimulus type
+(e.g. every type after every type equally often), for any number of types,
+without generating and testing sequences until one works.
+
+To generate the blocks of many subjects at once and save them for the task scripts, run
+    python randomization.py --subjects subj01,subj02,subj03 --output schedules.bin [--seed 1234]
+(or --subjects-file with one subject ID per line). Every subject gets its own seed, derived
+from the base seed and the subject ID, so any schedule can be generated again exactly. The
+task scripts then load the blocks of a subject with
+    blocks = load_schedule('schedules.bin', 'subj01')
+without reading the schedules of the other subjects.
+
 This script has not been thoroughly tested for boundary cases... Be careful
-and use test_correctness() to test your results. If you get an assertion
-error, something is wrong.
+and use test_correctness() to test your results, or validate_blocks() to test
+many blocks at once, e.g.
+    python randomization.py --blocks 1000000 --method eulerian --validate
+If you get an assertion error, something is wrong.
 """
 
 
+import os
+import sys
+import math
 import pickle
-import random
+import struct
+import hashlib
+import argparse
+import tempfile
+import concurrent.futures
+import numpy as np
 
 
 NUM_ORDINARY_STIM_TYPES = 2
 NUM_ORD_STIM_PER_TYPE_PER_BLOCK = 6
 NUM_BLOCKS = 30
+SCHEDULE_FILE_MAGIC = b'RANDSCH1'
+VALIDATION_CHUNK_BLOCKS = 2 ** 16
+VALIDATION_ALPHA = 1e-3
 
 
-def test_correctness(block_result):
-    assert(len(block_result) == NUM_ORDINARY_STIM_TYPES * NUM_ORD_STIM_PER_TYPE_PER_BLOCK * 2)
+def test_correctness(block_result, num_types=NUM_ORDINARY_STIM_TYPES, num_per_type=NUM_ORD_STIM_PER_TYPE_PER_BLOCK):
+    assert(len(block_result) == num_types * num_per_type * 2)
     # count
-    pair_counters = [0 for _ in range(NUM_ORDINARY_STIM_TYPES + 1)]
-    stim_counters = [0 for _ in range(NUM_ORDINARY_STIM_TYPES + 1)]
+    pair_counters = [0 for _ in range(num_types + 1)]
+    stim_counters = [0 for _ in range(num_types + 1)]
     for i in range(len(block_result)):
         stim_counters[block_result[i]] += 1
-        if block_result[i] != NUM_ORDINARY_STIM_TYPES:
+        if block_result[i] != num_types:
             continue
         pair_counters[block_result[i - 1]] += 1
     # number of stims
-    assert(stim_counters.pop() == NUM_ORDINARY_STIM_TYPES * NUM_ORD_STIM_PER_TYPE_PER_BLOCK)
-    assert(all([c == NUM_ORD_STIM_PER_TYPE_PER_BLOCK for c in stim_counters]))
+    assert(stim_counters.pop() == num_types * num_per_type)
+    assert(all([c == num_per_type for c in stim_counters]))
     # number of pairs
-    should_be = NUM_ORDINARY_STIM_TYPES * NUM_ORD_STIM_PER_TYPE_PER_BLOCK / (NUM_ORDINARY_STIM_TYPES + 1)
+    should_be = num_types * num_per_type // (num_types + 1)
     assert(all([c == should_be for c in pair_counters]))
 
 
+def _chi2_sf(statistic, df):
+    """
+    Probability that a chi-square variable with df degrees of freedom is at least statistic
+    (Wilson-Hilferty approximation, which is good enough to flag a biased generator).
+    """
+    if df <= 0 or statistic <= 0:
+        return 1.0
+    z = ((statistic / df) ** (1.0 / 3) - (1 - 2.0 / (9 * df))) / math.sqrt(2.0 / (9 * df))
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def _chi2_equal(counts):
+    """
+    Chi-square statistic and degrees of freedom of every row of counts being split equally among its columns.
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    expected = counts.mean(axis=-1, keepdims=True)
+    used = expected[..., 0] > 0
+    statistic = (((counts - expected) ** 2)[used] / expected[used]).sum()
+    return float(statistic), int(used.sum()) * (counts.shape[-1] - 1)
+
+
+def validate_blocks(blocks, num_types=NUM_ORDINARY_STIM_TYPES, num_per_type=NUM_ORD_STIM_PER_TYPE_PER_BLOCK,
+                    alpha=VALIDATION_ALPHA, special_positions=False, chunk_blocks=VALIDATION_CHUNK_BLOCKS):
+    """
+    Validate a batch of blocks (e.g. millions from generate_blocks()) at once.
+    Checks every block exactly like test_correctness() (the first stimulus follows the last one), and tests
+    whether the generator is unbiased, i.e. whether the ordinary stimulus types are interchangeable:
+    - at every position, every ordinary stimulus type appears equally often
+    - every ordinary type follows itself equally often, every ordinary type follows other ordinary types
+      equally often, the special stimulus follows every ordinary type equally often, and every ordinary type
+      follows the special stimulus equally often
+    - if special_positions, the special stimulus appears equally often at every position (which is not the
+      case for generate_blocks(), where blocks always start with an ordinary stimulus)
+    :param blocks: a 2-dimensional integer array (number of blocks x block length)
+    :param num_types: (integer) number of ordinary stimulus types
+    :param num_per_type: (integer) number of each ordinary stimulus type per block
+    :param alpha: (float) significance level of the bias tests
+    :param special_positions: (boolean) whether to test the positions of the special stimulus too
+    :param chunk_blocks: (integer) number of blocks to count at once
+    :return: a dictionary with
+             'num_blocks',
+             'bad_count_blocks': indexes of the blocks with wrong numbers of stimuli,
+             'bad_pair_blocks': indexes of the blocks with wrong numbers of special stimuli after each type,
+             'positions': (block length x num_types + 1) counts of every stimulus at every position,
+             'transitions': (num_types + 1 x num_types + 1) total counts of stimulus j following stimulus i,
+             'tests': a list of (name, chi-square, degrees of freedom, p value, passed),
+             'ok': whether everything passed
+    """
+    blocks = np.asarray(blocks)
+    if blocks.ndim != 2:
+        raise ValueError('Blocks should be a 2-dimensional array (number of blocks x block length).')
+    num_blocks, length = blocks.shape
+    n = num_types + 1
+    if length != num_types * num_per_type * 2:
+        raise ValueError('Block length %d does not match %d types x %d per type.' % (length, num_types, num_per_type))
+    if blocks.size and (blocks.min() < 0 or blocks.max() > num_types):
+        raise ValueError('Stimuli should be between 0 and %d.' % num_types)
+
+    positions = np.zeros(length * n, dtype=np.int64)
+    transitions = np.zeros(n * n, dtype=np.int64)
+    bad_count_blocks, bad_pair_blocks = [], []
+    expected_counts = np.array([num_per_type] * num_types + [num_types * num_per_type])
+    expected_pairs = num_types * num_per_type // n
+    for begin in range(0, num_blocks, chunk_blocks):
+        chunk = blocks[begin:begin + chunk_blocks].astype(np.int64)
+        rows = np.arange(len(chunk))[:, None]
+        # per block counts, with a different range of bins for every block
+        stim_counts = np.bincount((chunk + n * rows).ravel(), minlength=len(chunk) * n).reshape(-1, n)
+        pair_codes = np.roll(chunk, 1, axis=1) * n + chunk
+        block_transitions = np.bincount((pair_codes + n * n * rows).ravel(),
+                                        minlength=len(chunk) * n * n).reshape(-1, n, n)
+        bad_count_blocks.extend(begin + np.flatnonzero((stim_counts != expected_counts).any(axis=1)))
+        bad_pair_blocks.extend(begin + np.flatnonzero((block_transitions[:, :, num_types] != expected_pairs)
+                                                      .any(axis=1)))
+        positions += np.bincount((np.arange(length) * n + chunk).ravel(), minlength=length * n)
+        transitions += block_transitions.sum(axis=0).ravel()
+    positions = positions.reshape(length, n)
+    transitions = transitions.reshape(n, n)
+
+    ordinary = np.arange(num_types)
+    off_diagonal = ~np.eye(num_types, dtype=bool)
+    tests = [('ordinary types at every position', positions[:, :num_types]),
+             ('ordinary type after itself', transitions[ordinary, ordinary]),
+             ('ordinary type after another ordinary type', transitions[:num_types, :num_types][off_diagonal]),
+             ('special stimulus after ordinary types', transitions[:num_types, num_types]),
+             ('ordinary types after special stimulus', transitions[num_types, :num_types])]
+    if special_positions:
+        tests.append(('special stimulus at every position', positions[:, num_types]))
+    tests = [(name,) + _chi2_equal(counts) for name, counts in tests
+             if counts.size]  # e.g. with one ordinary type, no ordinary type follows another one
+    tests = [(name, statistic, df, _chi2_sf(statistic, df), _chi2_sf(statistic, df) >= alpha)
+             for name, statistic, df in tests]
+    return {'num_blocks': num_blocks, 'bad_count_blocks': [int(i) for i in bad_count_blocks],
+            'bad_pair_blocks': [int(i) for i in bad_pair_blocks], 'positions': positions,
+            'transitions': transitions, 'tests': tests,
+            'ok': not bad_count_blocks and not bad_pair_blocks and all(test[-1] for test in tests)}
+
+
+def print_validation(report):
+    """
+    Print the result of validate_blocks().
+    :param report: the dictionary returned by validate_blocks()
+    """
+    print('%d blocks' % report['num_blocks'])
+    for key, description in [('bad_count_blocks', 'wrong numbers of stimuli'),
+                             ('bad_pair_blocks', 'wrong numbers of special stimuli after each type')]:
+        bad = report[key]
+        print('%d blocks with %s%s' % (len(bad), description, (': %s...' % bad[:10]) if bad else ''))
+    print('transitions (row: previous stimulus, column: next stimulus):')
+    print(report['transitions'])
+    for name, statistic, df, p, passed in report['tests']:
+        print('%-45s chi2 = %12.2f, df = %5d, p = %.3g %s' % (name, statistic, df, p, '' if passed else 'BIASED'))
+    print('OK' if report['ok'] else 'FAILED')
+
+
+def generate_blocks(num_blocks=NUM_BLOCKS, num_types=NUM_ORDINARY_STIM_TYPES,
+                    num_per_type=NUM_ORD_STIM_PER_TYPE_PER_BLOCK, seed=None, method='insertion'):
+    """
+    Generate randomized blocks, all at once.
+    With method 'insertion', each block is made of pairs of (ordinary stimulus, special stimulus) in random
+    order, with more ordinary stimuli inserted before random pairs, and more special stimuli inserted after
+    random pairs.
+    With method 'eulerian', each block is a random sequence with the transitions of special_transitions()
+    (see eulerian_sequence()), with the ordinary stimulus types relabeled at random, so that the ordinary
+    stimuli also follow each other (as) equally often (as possible).
+    :param num_blocks: (integer) number of blocks
+    :param num_types: (integer) number of ordinary stimulus types
+    :param num_per_type: (integer) number of each ordinary stimulus type per block
+                         (has to be a multiple of num_types + 1)
+    :param seed: an integer seed, a numpy.random.SeedSequence or a numpy.random.Generator
+    :param method: 'insertion' or 'eulerian'
+    :return: a 2-dimensional integer array (num_blocks x block length), one block per row;
+             ordinary stimuli are 0, 1, ..., num_types - 1, and the special stimulus is num_types
+    """
+    if num_per_type % (num_types + 1) != 0:
+        raise ValueError('Number of stimuli per type (%d) is not a multiple of number of types + 1 (%d).'
+                         % (num_per_type, num_types + 1))
+    rng = np.random.default_rng(seed)
+    dtype = np.int8 if num_types < 127 else np.int32
+    if method == 'eulerian':
+        transitions = special_transitions(num_types, num_per_type)
+        blocks = np.empty((num_blocks, 2 * num_types * num_per_type), dtype=dtype)
+        for b in range(num_blocks):  # start with a random ordinary stim, and leave out the last (= first) stim
+            sequence = eulerian_sequence(transitions, start=int(rng.integers(num_types)), rng=rng)[:-1]
+            # relabel the ordinary stimuli at random, so that no ordinary type follows another more often
+            # on average when the transitions between ordinary types cannot be all equal
+            blocks[b] = np.append(rng.permutation(num_types), num_types)[sequence]
+        return blocks
+    elif method != 'insertion':
+        raise ValueError('Unknown method %r.' % method)
+    num_ord_spe_pairs_per_type = num_types * num_per_type // (num_types + 1)
+    num_pairs = num_types * num_ord_spe_pairs_per_type
+    num_extra = num_ord_spe_pairs_per_type  # number of more ordinary stimuli, and of more special stimuli
+
+    # randomize pairs of ordinary + special, and the more ordinary stimuli
+    pair_ords = rng.permuted(np.tile(np.repeat(np.arange(num_types, dtype=dtype), num_ord_spe_pairs_per_type),
+                                     (num_blocks, 1)), axis=1)
+    extra_ords = rng.permuted(np.tile(np.repeat(np.arange(num_types, dtype=dtype), num_extra // num_types),
+                                      (num_blocks, 1)), axis=1)
+    # places to insert more ordinary stim (before a pair, or at the end) and more special stim (after a pair)
+    extra_ord_indexes = rng.integers(0, num_pairs + 1, size=(num_blocks, num_extra))
+    extra_spe_indexes = rng.integers(0, num_pairs, size=(num_blocks, num_extra))
+
+    # construct the blocks by sorting all stimuli by their positions:
+    # 4i for ordinary stim inserted before pair i, 4i + 1 and 4i + 2 for pair i,
+    # 4i + 3 for special stim inserted after pair i
+    pair_positions = np.broadcast_to(4 * np.arange(num_pairs), (num_blocks, num_pairs))
+    positions = np.concatenate([4 * extra_ord_indexes, pair_positions + 1, pair_positions + 2,
+                                4 * extra_spe_indexes + 3], axis=1)
+    special = np.full((num_blocks, num_pairs + num_extra), num_types, dtype=dtype)
+    stims = np.concatenate([extra_ords, pair_ords, special], axis=1)
+    order = np.argsort(positions, axis=1, kind='stable')
+    return np.take_along_axis(stims, order, axis=1)
+
+
+def special_transitions(num_types=NUM_ORDINARY_STIM_TYPES, num_per_type=NUM_ORD_STIM_PER_TYPE_PER_BLOCK):
+    """
+    Get the transition counts of a block in the design described at the top of this file, where the
+    first stimulus in a block counts as following the last one (as in test_correctness()).
+    The special stimulus follows every stimulus type (including itself) equally often, and the ordinary
+    stimuli follow every ordinary stimulus type as equally often as possible.
+    :param num_types: (integer) number of ordinary stimulus types
+    :param num_per_type: (integer) number of each ordinary stimulus type per block
+                         (has to be a multiple of num_types + 1)
+    :return: a 2-dimensional integer array where [i, j] is the number of times stimulus j follows stimulus i
+    """
+    if num_per_type % (num_types + 1) != 0:
+        raise ValueError('Number of stimuli per type (%d) is not a multiple of number of types + 1 (%d).'
+                         % (num_per_type, num_types + 1))
+    ord_after_ord = num_per_type // (num_types + 1)  # times any ordinary stim follows a given ordinary stim
+    spe_after_each = num_types * ord_after_ord
+    transitions = np.zeros((num_types + 1, num_types + 1), dtype=np.int64)
+    transitions[:, num_types] = spe_after_each
+    transitions[num_types, :num_types] = spe_after_each
+    for k in range(num_types):  # each row and column of the ordinary part adds up to ord_after_ord
+        transitions[np.arange(num_types), (np.arange(num_types) + k) % num_types] = \
+            ord_after_ord // num_types + (1 if k < ord_after_ord % num_types else 0)
+    return transitions
+
+
+def eulerian_sequence(transitions, start=None, rng=None):
+    """
+    Construct a random sequence in which stimulus j follows stimulus i exactly transitions[i][j] times.
+    All such sequences (with the same start) are equally likely. This is a random Eulerian path in the
+    graph with transitions[i][j] edges from i to j: a random spanning tree of the last edges leaving
+    every stimulus (toward the end of the sequence) is drawn with Wilson's algorithm, the other edges
+    leaving every stimulus are shuffled, and the edges are followed from the start.
+    It takes linear time in the length of the sequence, and never retries.
+    :param transitions: a 2-dimensional (n x n) array of non-negative integers
+    :param start: (integer) the first stimulus. If every stimulus is followed as many times as it follows
+                  others, the sequence ends with the start too (so that the sequence without its last
+                  stimulus has the transitions when the first stimulus counts as following the last one),
+                  and the start can be any stimulus in the transitions (random if None).
+                  Otherwise it must be the only stimulus that is followed once more than it follows others.
+    :param rng: an integer seed, a numpy.random.SeedSequence or a numpy.random.Generator
+    :return: an integer array of length (number of transitions + 1)
+    """
+    rng = np.random.default_rng(rng)
+    transitions = np.asarray(transitions, dtype=np.int64)
+    n = transitions.shape[0]
+    if transitions.shape != (n, n) or (transitions < 0).any():
+        raise ValueError('Transitions should be a square array of non-negative integers.')
+    out_degree, in_degree = transitions.sum(axis=1), transitions.sum(axis=0)
+    active = np.flatnonzero(out_degree + in_degree)
+    if len(active) == 0:
+        raise ValueError('There are no transitions.')
+
+    # find the start and end
+    surplus = out_degree - in_degree
+    if not surplus.any():
+        if start is None:
+            start = int(rng.choice(active))
+        elif start not in active:
+            raise ValueError('Stimulus %d is not in the transitions.' % start)
+        end = start
+    else:
+        starts, ends = np.flatnonzero(surplus == 1), np.flatnonzero(surplus == -1)
+        if len(starts) != 1 or len(ends) != 1 or np.abs(surplus).sum() != 2:
+            raise ValueError('No sequence has these transitions: the number of times each stimulus is '
+                             'followed and follows others should be equal, except for the start and the end.')
+        if start is not None and start != starts[0]:
+            raise ValueError('A sequence with these transitions has to start with %d.' % starts[0])
+        start, end = int(starts[0]), int(ends[0])
+
+    # every stimulus has to be able to reach the end
+    reached, stack = {end}, [end]
+    while stack:
+        for i in np.flatnonzero(transitions[:, stack.pop()]):
+            if i not in reached:
+                reached.add(i)
+                stack.append(i)
+    if any(i not in reached for i in active):
+        raise ValueError('No sequence has these transitions: they are not connected.')
+
+    # Wilson's algorithm: random tree of last exits toward the end, from loop-erased random walks
+    last_exit = {}
+    in_tree = {end}
+    for i in active:
+        j = i
+        while j not in in_tree:  # walk until reaching the tree, keeping only the latest exit of every stim
+            last_exit[j] = int(rng.choice(n, p=transitions[j] / out_degree[j]))
+            j = last_exit[j]
+        j = i
+        while j not in in_tree:
+            in_tree.add(j)
+            j = last_exit[j]
+
+    # shuffle the exits of every stimulus, with the last exit last
+    exits = []
+    for i in range(n):
+        targets = np.repeat(np.arange(n), transitions[i])
+        if i != end and out_degree[i]:
+            targets = np.delete(targets, np.searchsorted(targets, last_exit[i]))  # targets are sorted
+            targets = np.append(rng.permutation(targets), last_exit[i])
+        else:
+            targets = rng.permutation(targets)
+        exits.append(targets.tolist())
+
+    # follow the edges
+    sequence = np.empty(out_degree.sum() + 1, dtype=np.int64)
+    sequence[0] = current = start
+    next_exit = [0] * n
+    for k in range(1, len(sequence)):
+        nxt = exits[current][next_exit[current]]
+        next_exit[current] += 1
+        sequence[k] = current = nxt
+    return sequence
+
+
+def subject_seed(subject_id, base_seed):
+    """
+    Derive the seed of a subject, independent from the seeds of other subjects.
+    :param subject_id: subject ID (converted to string)
+    :param base_seed: (integer) the seed of the whole experiment
+    :return: a numpy.random.SeedSequence
+    """
+    subject_hash = hashlib.blake2b(str(subject_id).encode('utf-8'), digest_size=16).digest()
+    return np.random.SeedSequence([base_seed, int.from_bytes(subject_hash, 'little')])
+
+
+def _subject_blocks(args):
+    subject_id, base_seed, kwargs = args
+    return generate_blocks(seed=subject_seed(subject_id, base_seed), **kwargs)
+
+
+def generate_schedules(subject_ids, schedule_file, num_blocks=NUM_BLOCKS, num_types=NUM_ORDINARY_STIM_TYPES,
+                       num_per_type=NUM_ORD_STIM_PER_TYPE_PER_BLOCK, base_seed=None, method='insertion',
+                       workers=None):
+    """
+    Generate the blocks of every subject in parallel, and save them all in one file to be read with
+    load_schedule() or ScheduleStore.
+    The file starts with a header (pickled dictionary of the subject IDs and the parameters), followed by
+    the blocks of all subjects as one (number of subjects x num_blocks x block length) array.
+    :param subject_ids: a list of subject IDs (strings)
+    :param schedule_file: file name of the schedules
+    :param num_blocks: (integer) number of blocks per subject
+    :param num_types: (integer) number of ordinary stimulus types
+    :param num_per_type: (integer) number of each ordinary stimulus type per block
+    :param base_seed: (integer) the seed of the whole experiment. If None, a random one is used (and saved in
+                      the file, so that the schedules can still be generated again)
+    :param method: 'insertion' or 'eulerian' (see generate_blocks())
+    :param workers: (integer) number of processes (default: number of CPUs)
+    :return: the base seed
+    """
+    subject_ids = [str(subject_id) for subject_id in subject_ids]
+    if len(set(subject_ids)) != len(subject_ids):
+        raise ValueError('Subject IDs are not unique.')
+    if base_seed is None:
+        base_seed = np.random.SeedSequence().entropy
+    kwargs = {'num_blocks': num_blocks, 'num_types': num_types, 'num_per_type': num_per_type, 'method': method}
+    tasks = [(subject_id, base_seed, kwargs) for subject_id in subject_ids]
+    if workers == 1 or len(subject_ids) < 2:
+        schedules = [_subject_blocks(task) for task in tasks]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            chunk_size = max(1, len(tasks) // (4 * (workers or os.cpu_count() or 1)))
+            schedules = list(executor.map(_subject_blocks, tasks, chunksize=chunk_size))
+    schedules = np.stack(schedules) if schedules else np.empty((0, num_blocks, 0), dtype=np.int8)
+
+    header = pickle.dumps({'subjects': {subject_id: i for i, subject_id in enumerate(subject_ids)},
+                           'shape': schedules.shape[1:], 'dtype': schedules.dtype.str,
+                           'base_seed': base_seed, 'parameters': kwargs}, protocol=pickle.HIGHEST_PROTOCOL)
+    # write to a temporary file first, so that a task script never reads a half-written file
+    fd, temp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(schedule_file)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as outfile:
+            outfile.write(SCHEDULE_FILE_MAGIC + struct.pack('<Q', len(header)))
+            outfile.write(header)
+            outfile.write(np.ascontiguousarray(schedules).tobytes())
+        os.replace(temp_file, schedule_file)
+    except BaseException:
+        os.remove(temp_file)
+        raise
+    return base_seed
+
+
+class ScheduleStore(object):
+    """
+    Schedules saved by generate_schedules(). The blocks of a subject are read from the file (memory mapped)
+    only when asked for, e.g.
+        store = ScheduleStore('schedules.bin')
+        blocks = store['subj01']
+    """
+
+    def __init__(self, schedule_file):
+        """
+        :param schedule_file: file name of the schedules
+        """
+        with open(schedule_file, 'rb') as infile:
+            magic = infile.read(len(SCHEDULE_FILE_MAGIC))
+            if magic != SCHEDULE_FILE_MAGIC:
+                raise ValueError('%s is not a schedule file.' % schedule_file)
+            header_size = struct.unpack('<Q', infile.read(8))[0]
+            header = pickle.loads(infile.read(header_size))
+        self.schedule_file = schedule_file
+        self.subjects = header['subjects']
+        self.base_seed = header['base_seed']
+        self.parameters = header['parameters']
+        self._schedules = None
+        if self.subjects:
+            self._schedules = np.memmap(schedule_file, dtype=np.dtype(header['dtype']), mode='r',
+                                        offset=len(SCHEDULE_FILE_MAGIC) + 8 + header_size,
+                                        shape=(len(self.subjects),) + tuple(header['shape']))
+
+    def __contains__(self, subject_id):
+        return str(subject_id) in self.subjects
+
+    def __len__(self):
+        return len(self.subjects)
+
+    def __getitem__(self, subject_id):
+        """
+        :param subject_id: subject ID
+        :return: a 2-dimensional integer array (number of blocks x block length) of the subject
+        """
+        if str(subject_id) not in self.subjects:
+            raise KeyError('No schedule for subject %s in %s.' % (subject_id, self.schedule_file))
+        return np.array(self._schedules[self.subjects[str(subject_id)]])
+
+    def regenerate(self, subject_id):
+        """
+        Generate the blocks of a subject again from its seed (they should be the same as the saved ones).
+        :param subject_id: subject ID
+        :return: a 2-dimensional integer array (number of blocks x block length)
+        """
+        return _subject_blocks((str(subject_id), self.base_seed, self.parameters))
+
+
+def load_schedule(schedule_file, subject_id):
+    """
+    Load the blocks of one subject, saved by generate_schedules().
+    :param schedule_file: file name of the schedules
+    :param subject_id: subject ID
+    :return: a 2-dimensional integer array (number of blocks x block length)
+    """
+    return ScheduleStore(schedule_file)[subject_id]
+
+
 def main():
-    results = []
-    num_stim_types = NUM_ORDINARY_STIM_TYPES + 1  # 1 special stim
-    num_spe_stim_per_block = NUM_ORDINARY_STIM_TYPES * NUM_ORD_STIM_PER_TYPE_PER_BLOCK
-    num_stim_per_block = num_spe_stim_per_block * 2
-    num_ord_spe_pairs = num_spe_stim_per_block / num_stim_types
-    for _ in range(NUM_BLOCKS):
-        # randomize pairs of ordinary + special
-        ord_spe_stim_pairs = [i for i in range(NUM_ORDINARY_STIM_TYPES)
-                                for _ in range(num_ord_spe_pairs)]
-        random.shuffle(ord_spe_stim_pairs)
-        # places to insert more ordinary stim
-        ord_indexes = sorted([random.choice(range(num_ord_spe_pairs + 1))  # can insert before or after a pair (so + 1)
-                              for _ in range(num_ord_spe_pairs)])
-        ord_order = [i for i in range(NUM_ORDINARY_STIM_TYPES)
-                       for _ in range(len(ord_indexes) / 2)]
-        random.shuffle(ord_order)
-        # places to insert more special stim (after another special stim)
-        spe_indexes = sorted([random.choice(range(num_ord_spe_pairs))  # can insert after a pair, not before
-                              for _ in range(num_ord_spe_pairs)])
-        # construct the result list
-        ord_counter, spe_counter = 0, 0
-        block_result = []
-        for i in range(len(ord_spe_stim_pairs) + 1):
-            while ord_counter < len(ord_indexes) and ord_indexes[ord_counter] == i:
-                block_result.append(ord_order[ord_counter])  # append an ordinary stim
-                ord_counter += 1
-            if i < len(ord_spe_stim_pairs):
-                block_result.append(ord_spe_stim_pairs[i])  # append an ordinary stim
-                block_result.append(NUM_ORDINARY_STIM_TYPES)  # append a special stim
-            while spe_counter < len(spe_indexes) and spe_indexes[spe_counter] == i:
-                block_result.append(NUM_ORDINARY_STIM_TYPES)  # append a special stim
-                spe_counter += 1
-        print block_result  # just printing to console because I'm lazy
-        test_correctness(block_result)
+    parser = argparse.ArgumentParser(description='Generate randomized blocks of stimuli.')
+    parser.add_argument('--subjects', help='comma separated subject IDs')
+    parser.add_argument('--subjects-file', help='file with one subject ID per line')
+    parser.add_argument('--output', help='file to save the schedules of the subjects to')
+    parser.add_argument('--seed', type=int, help='base seed of the experiment (default: random)')
+    parser.add_argument('--blocks', type=int, default=NUM_BLOCKS,
+                        help='number of blocks (default: %d)' % NUM_BLOCKS)
+    parser.add_argument('--types', type=int, default=NUM_ORDINARY_STIM_TYPES,
+                        help='number of ordinary stimulus types (default: %d)' % NUM_ORDINARY_STIM_TYPES)
+    parser.add_argument('--per-type', type=int, default=NUM_ORD_STIM_PER_TYPE_PER_BLOCK,
+                        help='number of each ordinary stimulus type per block (default: %d)'
+                             % NUM_ORD_STIM_PER_TYPE_PER_BLOCK)
+    parser.add_argument('--method', choices=['insertion', 'eulerian'], default='insertion',
+                        help='randomization method (default: insertion)')
+    parser.add_argument('--workers', type=int, help='number of processes (default: number of CPUs)')
+    parser.add_argument('--validate', action='store_true',
+                        help='validate the generated blocks with validate_blocks() instead of printing them')
+    args = parser.parse_args()
+
+    subject_ids = []
+    if args.subjects:
+        subject_ids.extend(s.strip() for s in args.subjects.split(',') if s.strip())
+    if args.subjects_file:
+        with open(args.subjects_file, 'r') as infile:
+            subject_ids.extend(line.strip() for line in infile if line.strip())
+
+    if not subject_ids:
+        blocks = generate_blocks(args.blocks, args.types, args.per_type, seed=args.seed, method=args.method)
+        if args.validate:
+            report = validate_blocks(blocks, args.types, args.per_type)
+            print_validation(report)
+            sys.exit(0 if report['ok'] else 1)
+        for block_result in blocks:
+            print(block_result.tolist())  # just printing to console because I'm lazy
+            test_correctness(block_result.tolist(), args.types, args.per_type)
+        return
+    if not args.output:
+        sys.exit('Specify the file to save the schedules to with --output.')
+    base_seed = generate_schedules(subject_ids, args.output, args.blocks, args.types, args.per_type,
+                                   base_seed=args.seed, method=args.method, workers=args.workers)
+    print('Saved the schedules of %d subjects to %s (base seed %d).' % (len(subject_ids), args.output, base_seed))
 
 
 if __name__ == '__main__':
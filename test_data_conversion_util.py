@@ -0,0 +1,180 @@
+"""
+Tests for data_conversion_util.py. Run with
+    python -m pytest test_data_conversion_util.py
+"""
+
+import random
+
+import data_conversion_util as dcu
+
+
+WIDE_COLS = ['id', 'trials.0.a', 'trials.0.b', 'trials.1.a', 'trials.1.b']
+WIDE_DATA = [['p1', 1, 2, 3, 4], ['p2', 5, 6, 7, 8]]
+
+
+def _recursive_flatten(obj, obj_id=None):
+    """
+    The recursive flatten() that Flattener replaced, to compare with.
+    """
+    names, values = ([], []) if obj_id is None else (['id'], [obj_id])
+
+    def _flatten(x, name=''):
+        if type(x) is dict:
+            for k in x:
+                _flatten(x[k], name + k + '.')
+        elif type(x) is list:
+            for i, a in enumerate(x):
+                _flatten(a, name + str(i) + '.')
+        elif x is not None:
+            names.append(name[:-1])
+            values.append(x)
+
+    if hasattr(obj, '__next__'):
+        for i, a in enumerate(obj):
+            _flatten(a, str(i) + '.')
+    else:
+        _flatten(obj)
+    pairs = sorted(zip(names, values))
+    return [name for name, _ in pairs], [value for _, value in pairs]
+
+
+def _random_object(rng, depth=0):
+    r = rng.random()
+    if depth > 2 or r < 0.3:
+        return rng.choice([1, 2.5, 'x', None, True])
+    if r < 0.65:
+        return {rng.choice('abcd'): _random_object(rng, depth + 1) for _ in range(rng.randint(0, 3))}
+    return [_random_object(rng, depth + 1) for _ in range(rng.randint(0, 3))]
+
+
+def _assert_same_flatten(flattener, obj, obj_id=None):
+    expected = _recursive_flatten(iter(obj) if type(obj) is tuple else obj, obj_id)
+    names, values = flattener.flatten(iter(obj) if type(obj) is tuple else obj, obj_id)
+    assert (list(names), values) == expected
+    assert dcu.flatten(iter(obj) if type(obj) is tuple else obj, obj_id) == expected
+
+
+def test_flatten_matches_recursive_flatten():
+    flattener = dcu.Flattener()
+    cases = [{}, [], {'a': 1}, {'b': {'c': [1, 2, {'d': 'x'}]}, 'a': None}, [[1], [2, [3]]],
+             {'a': [{'x': 1, 'y': 2}, {'x': 3}], 'b': True}, {'': 1, 'a': {'': 2}}]
+    for obj in cases:
+        for obj_id in (None, 'p1'):
+            _assert_same_flatten(flattener, obj, obj_id)
+            _assert_same_flatten(flattener, obj, obj_id)  # the second time from the shape cache
+
+
+def test_flatten_matches_recursive_flatten_on_random_objects():
+    rng = random.Random(0)
+    flattener = dcu.Flattener()
+    objs = [_random_object(rng) for _ in range(2000)]
+    objs += objs[:200]  # the same shapes again
+    for i, obj in enumerate(objs):
+        _assert_same_flatten(flattener, obj, None if i % 2 else 'p%d' % i)
+
+
+def test_flatten_many_matches_recursive_flatten():
+    rng = random.Random(1)
+    objs = [{'trials': [{'rt': rng.random(), 'key': rng.choice('fj')} for _ in range(3)]} for _ in range(50)]
+    ids = ['p%d' % i for i in range(len(objs))]
+    data_list = dcu.Flattener().flatten_many(objs, ids)
+    assert [(list(names), values) for names, values in data_list] == \
+        [_recursive_flatten(obj, obj_id) for obj, obj_id in zip(objs, ids)]
+
+
+def test_flatten_iterators_matches_recursive_flatten():
+    rng = random.Random(2)
+    flattener = dcu.Flattener()
+    for i in range(500):
+        objs = tuple(_random_object(rng) for _ in range(rng.randint(0, 12)))  # a tuple is flattened as iter()
+        _assert_same_flatten(flattener, objs, None if i % 2 else 'p%d' % i)
+
+
+def test_flatten_duplicate_names():
+    # 'a.b' is both a key and a path, so the names are not unique and the shape can't be cached
+    flattener = dcu.Flattener()
+    for obj in ({'a.b': 2, 'a': {'b': 1}}, {'a': {'b': 3}, 'a.b': 1}, ({'a.b': 2, 'a': {'b': 1}}, {'0': 5})):
+        for obj_id in (None, 'p1'):
+            _assert_same_flatten(flattener, obj, obj_id)
+            _assert_same_flatten(flattener, obj, obj_id)
+
+
+def _disk_table(col_names, rows, tmp_path):
+    table = dcu.DiskTable(scratch_dir=str(tmp_path), memory_budget=1)  # one chunk per row
+    for row in rows:
+        table.add(col_names, row)
+    table.flush()
+    return table
+
+
+def test_cut_and_stack_disk_table_keeps_duplicate_names(tmp_path):
+    # the longest common substrings of 'trials.0.a' and 'trials.1.a', and of the b's, are both 'trials.'
+    long_cols, long_data = dcu.cut_and_stack(WIDE_COLS, WIDE_DATA, 1, 2, 2)
+    assert long_cols == ['id', 'trials.', 'trials.']
+    with _disk_table(WIDE_COLS, WIDE_DATA, tmp_path) as table:
+        assert table.col_names == WIDE_COLS
+        disk_cols, disk_table = dcu.cut_and_stack(WIDE_COLS, table, 1, 2, 2)
+        with disk_table:
+            assert disk_cols == long_cols
+            assert list(disk_table) == [list(row) for row in long_data]
+            assert list(disk_table)[0] == ['p1', 1, 2]
+
+
+def test_cut_and_stack_disk_table_keeps_none_names(tmp_path):
+    wide_cols = ['id', 'pq', 'rs', 'tu', 'vw']  # no common substrings, so the long names are None
+    with _disk_table(wide_cols, WIDE_DATA, tmp_path) as table:
+        assert table.col_names == wide_cols
+        long_cols, long_table = dcu.cut_and_stack(wide_cols, table, 1, 2, 2)
+        with long_table:
+            assert long_cols == ['id', None, None]
+            assert long_table.col_names == long_cols
+            assert list(long_table) == [['p1', 1, 2], ['p1', 3, 4], ['p2', 5, 6], ['p2', 7, 8]]
+
+
+def _wide_records():
+    rng = random.Random(3)
+    data_list = []
+    for p in range(20):
+        trials = [{'rt': round(rng.random(), 3), 'key': rng.choice('fj')} for _ in range(12)]
+        trials[3]['note'] = 'late'  # only in some repetitions, so skipped
+        data_list.append(dcu.flatten({'age': rng.randint(18, 40), 'trials': trials, 'version': 2}, 'p%02d' % p))
+    return dcu.fill_missing_keys(data_list)
+
+
+def _round_trip(rep_col=None):
+    col_names, data = _wide_records()
+    layout = dcu.detect_repetition(col_names)
+    assert layout.skip_cols
+    long_cols, long_data = dcu.cut_and_stack(col_names, data, **layout.cut_kwargs())
+    if rep_col is not None:  # a column of repetition labels, with the rows shuffled
+        long_cols = long_cols + [rep_col]
+        long_data = [list(row) + [layout.labels[i % layout.cut_number]] for i, row in enumerate(long_data)]
+        random.Random(4).shuffle(long_data)
+    wide_cols, wide_data = dcu.pivot_wide(long_cols, long_data, layout.cut_names, rep_col=rep_col,
+                                          prefix=layout.prefix, rep_labels=layout.labels)
+    kept = [i for i in range(len(col_names)) if i not in layout.skip_cols]
+    assert wide_cols == [col_names[i] for i in kept]
+    assert sorted(wide_data) == sorted([row[i] for i in kept] for row in data)
+
+
+def test_pivot_wide_round_trip():
+    _round_trip()
+    _round_trip(rep_col='trial')
+
+
+def test_pivot_wide_round_trip_without_numpy(monkeypatch):
+    monkeypatch.setattr(dcu, 'np', None)
+    _round_trip()
+    _round_trip(rep_col='trial')
+
+
+def test_csv_functions_take_path_objects(tmp_path):
+    rows = [['p1', 1], ['p2', 2]]
+    for name in ('rows.csv', 'rows.csv.gz'):
+        dcu.list2csv(rows, tmp_path / name, ['id', 'value'])
+        assert list(dcu._read_csv_rows(tmp_path / name)) == [['id', 'value'], ['p1', '1'], ['p2', '2']]
+    folder = tmp_path / 'data'
+    folder.mkdir()
+    (folder / 'p1.json').write_text('{"a": 1}\n')
+    dcu.update_folder_csv(folder, tmp_path / 'folder.csv', workers=1)
+    assert list(dcu._read_csv_rows(tmp_path / 'folder.csv')) == [['0.a', 'id'], ['1', 'p1']]
@@ -14,55 +14,529 @@ It takes three command line arguments. Usage:
 Example:
     python trigger_sender.py t 500 1
 
-Note: Before starting actual key presses, the key will first be pressed 20 times
-continuously to determine the average time required to press this key. Make sure
-you discard the first 20 triggers. You can change the number below.
+Without a desktop session (e.g. to test a task script on a headless machine), the
+triggers can be sent as lines of text (the trigger key followed by a new line) to
+another output with --backend:
+    stdout   print the triggers
+    file     append the triggers to the file given by --path
+    pipe     write the triggers to the named pipe given by --path (created if needed;
+             it waits until the task script opens the pipe for reading)
+    socket   send the triggers to every task script connected to the UNIX socket
+             given by --path (--subscribers: number of task scripts to wait for)
+Example:
+    python trigger_sender.py t 500 1 --backend socket --path /tmp/scanner.sock
+
+Simulated responses can be sent together with the triggers, from a BIDS events.tsv
+file: every row is sent at the sum of the --events-time columns (seconds after the
+first trigger), as the value of its --events-column (the key to press, or the text
+to send). Rows with n/a in these columns are skipped. The events can go to another
+output with --events-backend and --events-path; --subscribers only applies to the
+triggers, so an events socket does not wait for task scripts to connect. --log saves
+when every trigger and event was scheduled and actually sent. Example:
+    python trigger_sender.py t 300 2 --events sub-01_task-face_events.tsv \\
+        --events-column response --events-time onset,response_time --log emit_log.tsv
+
+Trigger k is sent at (start time + k * interval) on a monotonic clock, so delays
+in pressing the key or in waking up from sleep do not add up over many triggers.
+The time required to press the key (or send a trigger) is measured at every
+trigger, and the next trigger is started that much earlier, so that it arrives on
+time even when the computer gets slower or faster during a run. At the end, the
+script prints how late the triggers arrived (mean, 99th percentile and maximum).
 """
 
 from __future__ import print_function
+import os
+import csv
 import sys
 import time
-import timeit
-import pyautogui
+import errno
+import heapq
+import socket
+import asyncio
+import argparse
+
+# sleep until this many seconds before each trigger, then busy-wait (time.sleep can wake up late)
+SPIN_SECONDS = 0.002
+# the estimate of the time required to send a trigger moves this fraction of the way to every new measurement
+LATENCY_SMOOTHING = 0.1
+# measurements this many (smoothed) deviations away from the estimate are ignored as outliers, unless
+# LATENCY_MAX_OUTLIERS of them come in a row (then the latency has really changed)
+LATENCY_OUTLIER_DEVIATIONS = 4.0
+LATENCY_MAX_OUTLIERS = 3
+# the estimate starts from the median of this many measurements (until then, triggers are not started earlier,
+# because a slow first send, e.g. while a connection is set up, would make the next triggers much too early)
+LATENCY_WARMUP = 5
+
+
+class TriggerBackend(object):
+    """
+    Where triggers are sent to. Subclasses implement send(), and close() if they need to.
+    """
+    line = b''
+
+    def send(self, message=None):
+        """
+        Send one trigger.
+        :param message: (string) the key or text to send instead of the one of the backend
+        """
+        raise NotImplementedError
+
+    def _line(self, message):
+        if message is None:
+            return self.line
+        return (message + '\n').encode('utf-8')
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class KeyboardBackend(TriggerBackend):
+    """
+    Press a key (needs pyautogui and a desktop session).
+    """
+
+    def __init__(self, key):
+        """
+        :param key: the key to press, as named by pyautogui
+        """
+        import pyautogui
+        if key not in pyautogui.KEYBOARD_KEYS:
+            raise ValueError('Invalid key: %s' % key)
+        self.press = pyautogui.press
+        self.key = key
+
+    def send(self, message=None):
+        # without the pause that pyautogui adds after every call (PAUSE, 0.1 s by default), so that the measured
+        # latency is the time until the key is pressed
+        self.press(self.key if message is None else message, _pause=False)
+
+
+class StdoutBackend(TriggerBackend):
+    """
+    Print the trigger (to standard output).
+    """
+
+    def __init__(self, message):
+        """
+        :param message: (string) the text of a trigger
+        """
+        self.line = (message + '\n').encode('utf-8')
+        self.fd = sys.stdout.fileno()
+
+    def send(self, message=None):
+        os.write(self.fd, self._line(message))
+
+
+class FileBackend(TriggerBackend):
+    """
+    Append the trigger to a file (or write it to a named pipe).
+    """
+
+    def __init__(self, message, path):
+        """
+        :param message: (string) the text of a trigger
+        :param path: file name
+        """
+        self.line = (message + '\n').encode('utf-8')
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+
+    def send(self, message=None):
+        os.write(self.fd, self._line(message))
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class PipeBackend(FileBackend):
+    """
+    Write the trigger to a named pipe, which is created if it does not exist.
+    Opening the pipe waits until another process opens it for reading.
+    """
+
+    def __init__(self, message, path):
+        """
+        :param message: (string) the text of a trigger
+        :param path: file name of the named pipe
+        """
+        if not os.path.exists(path):
+            os.mkfifo(path)
+        self.line = (message + '\n').encode('utf-8')
+        self.fd = os.open(path, os.O_WRONLY)
+
+
+class SocketBackend(TriggerBackend):
+    """
+    Send the trigger to every process connected to a UNIX socket. Processes can connect (subscribe) at
+    any time, and the ones that disconnect are dropped.
+    """
+
+    def __init__(self, message, path, subscribers=0, timeout=None):
+        """
+        :param message: (string) the text of a trigger
+        :param path: file name of the socket (replaced if it exists)
+        :param subscribers: (integer) number of processes to wait for before sending triggers
+        :param timeout: (float) maximum number of seconds to wait for them (default: no limit)
+        """
+        self.line = (message + '\n').encode('utf-8')
+        self.path = path
+        if os.path.exists(path):
+            os.remove(path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(16)
+        self.clients = []
+        self.server.settimeout(timeout)
+        try:
+            while len(self.clients) < subscribers:
+                self._add_client(self.server.accept()[0])
+        except socket.timeout:
+            self.close()
+            raise RuntimeError('Only %d of %d subscribers connected to %s.' % (len(self.clients), subscribers, path))
+        self.server.setblocking(False)
+
+    def _add_client(self, client):
+        client.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 16)
+        self.clients.append(client)
 
-# the key will first be pressed for this number of times
-# to calculate an average time required
-NUM_PRE_RUN = 20
+    def send(self, message=None):
+        line = self._line(message)
+        while True:  # new subscribers
+            try:
+                self._add_client(self.server.accept()[0])
+            except (BlockingIOError, socket.timeout):
+                break
+        for client in list(self.clients):
+            try:
+                client.sendall(line)
+            except OSError as e:
+                if e.errno not in (errno.EPIPE, errno.ECONNRESET):
+                    raise
+                client.close()
+                self.clients.remove(client)
+
+    def close(self):
+        for client in self.clients:
+            client.close()
+        self.clients = []
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+
+BACKENDS = {'keyboard': KeyboardBackend, 'stdout': StdoutBackend, 'file': FileBackend, 'pipe': PipeBackend,
+            'socket': SocketBackend}
+
+
+def make_backend(name, key, path=None, **kwargs):
+    """
+    :param name: one of the names in BACKENDS
+    :param key: the key to press, or the text of a trigger
+    :param path: file name (for the file, pipe and socket backends)
+    :param kwargs: other parameters of the backend
+    :return: a TriggerBackend
+    """
+    if name not in BACKENDS:
+        raise ValueError('Unknown backend: %s' % name)
+    if name in ('keyboard', 'stdout'):
+        return BACKENDS[name](key, **kwargs)
+    if not path:
+        raise ValueError('The %s backend needs a path.' % name)
+    return BACKENDS[name](key, path, **kwargs)
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+
+class LatencyEstimator(object):
+    """
+    Running estimate of the time required to send a trigger: an exponentially weighted moving average (EWMA)
+    of the measured times, ignoring outliers. The estimate is 0 until warmup measurements are in, and then
+    starts from their median.
+    """
+
+    def __init__(self, smoothing=LATENCY_SMOOTHING, outlier_deviations=LATENCY_OUTLIER_DEVIATIONS,
+                 max_outliers=LATENCY_MAX_OUTLIERS, warmup=LATENCY_WARMUP):
+        """
+        :param smoothing: (float) weight of a new measurement, between 0 and 1
+        :param outlier_deviations: (float) measurements more than this many smoothed absolute deviations away
+                                   from the estimate are outliers
+        :param max_outliers: (integer) number of outliers in a row after which they are used anyway
+        :param warmup: (integer) number of measurements to take the median of before the estimate is used
+        """
+        self.smoothing = smoothing
+        self.outlier_deviations = outlier_deviations
+        self.max_outliers = max_outliers
+        self.warmup = max(warmup, 1)
+        self.value = 0.0
+        self.deviation = 0.0
+        self.count = 0
+        self.outliers = []  # in a row
+        self._warmup_samples = []
+
+    def update(self, latency):
+        """
+        Add a measurement.
+        :param latency: (float) seconds required to send a trigger
+        :return: the new estimate
+        """
+        self.count += 1
+        if self.count <= self.warmup:
+            self._warmup_samples.append(latency)
+            if self.count == self.warmup:  # median and median absolute deviation, so a slow first send is ignored
+                self.value = _median(self._warmup_samples)
+                self.deviation = _median([abs(x - self.value) for x in self._warmup_samples])
+                self._warmup_samples = []
+            return self.value
+        error = latency - self.value
+        if abs(error) > self.outlier_deviations * self.deviation:
+            self.outliers.append(latency)
+            if len(self.outliers) < self.max_outliers:
+                return self.value
+            # the latency has changed: start again from the outliers
+            self.value = sum(self.outliers) / len(self.outliers)
+            self.deviation = sum(abs(x - self.value) for x in self.outliers) / len(self.outliers)
+        else:
+            self.value += self.smoothing * error
+            self.deviation += self.smoothing * (abs(error) - self.deviation)
+        self.outliers = []
+        return self.value
+
+
+def wait_until(deadline, spin_seconds=SPIN_SECONDS):
+    """
+    Wait until a time on the time.perf_counter() clock: sleep for most of the time, and busy-wait for the
+    last spin_seconds.
+    :param deadline: (float) time to wait until
+    :param spin_seconds: (float) number of seconds to busy-wait for
+    :return: the time when it stopped waiting
+    """
+    remaining = deadline - time.perf_counter() - spin_seconds
+    if remaining > 0:
+        time.sleep(remaining)
+    now = time.perf_counter()
+    while now < deadline:
+        now = time.perf_counter()
+    return now
+
+
+def send_triggers(send, num, interval, start_time=None, spin_seconds=SPIN_SECONDS, estimator=None):
+    """
+    Send triggers at fixed times: trigger k should arrive at start_time + k * interval, no matter how long
+    sending the previous triggers took. Every trigger is started earlier by the estimated time required to
+    send it (which is updated with every trigger). A trigger that is already late is sent right away (and the
+    next ones are still sent on time).
+    :param send: a function that sends one trigger
+    :param num: (integer) number of triggers
+    :param interval: (float) number of seconds between two triggers
+    :param start_time: (float) time of the first trigger on the time.perf_counter() clock (default: now)
+    :param spin_seconds: (float) number of seconds to busy-wait for before each trigger
+    :param estimator: a LatencyEstimator (default: a new one)
+    :return: a list of (scheduled time, time when sending started, time when sending finished) of every trigger
+    """
+    if start_time is None:
+        start_time = time.perf_counter()
+    if estimator is None:
+        estimator = LatencyEstimator()
+    times = []
+    for k in range(num):
+        deadline = start_time + k * interval
+        sent = wait_until(deadline - estimator.value, spin_seconds)
+        send()
+        done = time.perf_counter()
+        estimator.update(done - sent)
+        times.append((deadline, sent, done))
+    return times
+
+
+def jitter_stats(times):
+    """
+    Summarize how late the triggers were.
+    :param times: the list returned by send_triggers()
+    :return: a dictionary of the mean, 99th percentile and maximum of how late the triggers arrived (finished
+             sending; negative if early), and of how long sending took (in seconds)
+    """
+    if not times:
+        return {}
+    lateness = sorted(done - deadline for deadline, _, done in times)
+    durations = sorted(done - sent for _, sent, done in times)
+    stats = {}
+    for name, values in [('drift', lateness), ('send', durations)]:
+        stats[name + '_mean'] = sum(values) / len(values)
+        stats[name + '_p99'] = values[min(len(values) - 1, int(0.99 * len(values)))]
+        stats[name + '_max'] = values[-1]
+    return stats
+
+
+def read_events(tsv_file, value_column='trial_type', time_columns=('onset',)):
+    """
+    Read the events to send from a BIDS events.tsv file.
+    :param tsv_file: file name
+    :param value_column: column of the key or text to send
+    :param time_columns: columns whose sum is the time of an event, in seconds (e.g. onset and response_time)
+    :return: a list of (time, message) sorted by time; rows with n/a or empty values are skipped
+    """
+    events = []
+    with open(tsv_file, 'r', newline='') as infile:
+        reader = csv.DictReader(infile, delimiter='\t')
+        missing = [c for c in (value_column,) + tuple(time_columns) if c not in (reader.fieldnames or [])]
+        if missing:
+            raise ValueError('Columns not found in %s: %s' % (tsv_file, ', '.join(missing)))
+        for row in reader:
+            values = [row[c].strip() for c in (value_column,) + tuple(time_columns)]
+            if any(v in ('', 'n/a') for v in values):
+                continue
+            events.append((sum(float(v) for v in values[1:]), values[0]))
+    events.sort(key=lambda event: event[0])
+    return events
+
+
+def merge_streams(streams):
+    """
+    Merge several streams of events into one stream ordered by time (events at the same time are ordered
+    by stream).
+    :param streams: a list of lists of (time, message), each sorted by time
+    :return: a generator of (time, stream index, message)
+    """
+    def _label(i, stream):
+        return ((t, i, message) for t, message in stream)
+
+    return heapq.merge(*[_label(i, stream) for i, stream in enumerate(streams)])
+
+
+async def playback(channels, start_time=None, spin_seconds=SPIN_SECONDS):
+    """
+    Send the events of several channels, each to its own backend, at their times: sleep in the event loop
+    until shortly before an event, and then spin for the rest, yielding to the event loop every time
+    (like wait_until(), but without blocking other tasks in the loop). Like in send_triggers(),
+    every event is started earlier by the estimated time required to send it on its channel.
+    :param channels: a list of (name, TriggerBackend, events), where events are a list of (time in seconds
+                     after start_time, message) sorted by time
+    :param start_time: (float) time zero on the time.perf_counter() clock (default: now)
+    :param spin_seconds: (float) number of seconds to busy-wait for before each event
+    :return: a list of (channel name, message, scheduled time, time when sending started, time when sending
+             finished) of every event, in seconds after start_time
+    """
+    if start_time is None:
+        start_time = time.perf_counter()
+    estimators = [LatencyEstimator() for _ in channels]
+    log = []
+    for offset, i, message in merge_streams([events for _, _, events in channels]):
+        target = start_time + offset - estimators[i].value
+        delay = target - time.perf_counter() - spin_seconds
+        if delay > 0:
+            await asyncio.sleep(delay)
+        sent = time.perf_counter()
+        while sent < target:
+            await asyncio.sleep(0)
+            sent = time.perf_counter()
+        channels[i][1].send(message)
+        done = time.perf_counter()
+        estimators[i].update(done - sent)
+        log.append((channels[i][0], message, offset, sent - start_time, done - start_time))
+    return log
+
+
+def play_events(channels, start_time=None, spin_seconds=SPIN_SECONDS):
+    """
+    Run playback() in a new event loop.
+    :return: the list returned by playback()
+    """
+    return asyncio.run(playback(channels, start_time, spin_seconds))
+
+
+def write_emit_log(log, tsv_file):
+    """
+    Save the list returned by playback() as a tsv file.
+    :param log: a list of (channel name, message, scheduled time, time when sending started, time when sending
+                finished)
+    :param tsv_file: file name
+    """
+    with open(tsv_file, 'w', newline='') as outfile:
+        writer = csv.writer(outfile, delimiter='\t', lineterminator='\n')
+        writer.writerow(['channel', 'message', 'scheduled', 'sent', 'done'])
+        for name, message, scheduled, sent, done in log:
+            writer.writerow([name, message, '%.6f' % scheduled, '%.6f' % sent, '%.6f' % done])
+
+
+def print_stats(name, log, outfile):
+    """
+    Print the jitter_stats() of one channel of a playback() log.
+    """
+    stats = jitter_stats([(scheduled, sent, done) for channel, _, scheduled, sent, done in log if channel == name])
+    if stats:
+        print('%s drift (ms): mean %.3f, 99th percentile %.3f, max %.3f'
+              % (name.capitalize(), stats['drift_mean'] * 1e3, stats['drift_p99'] * 1e3, stats['drift_max'] * 1e3),
+              file=outfile)
+        print('%s send latency (ms): mean %.3f, 99th percentile %.3f, max %.3f'
+              % (name.capitalize(), stats['send_mean'] * 1e3, stats['send_p99'] * 1e3, stats['send_max'] * 1e3),
+              file=outfile)
 
 
 def main():
+    parser = argparse.ArgumentParser(description='Send triggers at a fixed interval.')
+    parser.add_argument('key', help='trigger key (or the text of a trigger for the other backends)')
+    parser.add_argument('num', type=int, help='number of triggers')
+    parser.add_argument('interval', type=float, help='time interval between two triggers (in seconds)')
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default='keyboard',
+                        help='where to send the triggers (default: keyboard)')
+    parser.add_argument('--path', help='file, named pipe or socket for the file, pipe and socket backends')
+    parser.add_argument('--subscribers', type=int, default=0,
+                        help='number of task scripts to wait for (socket backend of the triggers only; '
+                             'a separate --events-backend socket does not wait for subscribers)')
+    parser.add_argument('--events', help='BIDS events.tsv file of events to send together with the triggers')
+    parser.add_argument('--events-column', default='trial_type',
+                        help='column of the keys or texts of the events (default: trial_type)')
+    parser.add_argument('--events-time', default='onset',
+                        help='comma separated columns whose sum is the time of an event (default: onset)')
+    parser.add_argument('--events-backend', choices=sorted(BACKENDS),
+                        help='where to send the events (default: same as the triggers)')
+    parser.add_argument('--events-path', help='file, named pipe or socket for the events (default: --path)')
+    parser.add_argument('--log', help='tsv file to save the scheduled and actual times of the triggers and events')
+    args = parser.parse_args()
+
+    kwargs = {'subscribers': args.subscribers} if args.backend == 'socket' else {}
+    events_backend_name = args.events_backend or args.backend
+    events_path = args.events_path or args.path
     try:
-        # get command line arguments
-        key = sys.argv[1]
-        if key not in pyautogui.KEYBOARD_KEYS:
-            raise ValueError
-        num = int(sys.argv[2])
-        interval = float(sys.argv[3])
-
-        # get an average time of key press
-        def keypress():
-            pyautogui.press(key)
-
-        avg_time = timeit.timeit(keypress, number=NUM_PRE_RUN) / NUM_PRE_RUN
-        if avg_time > interval:
-            raise RuntimeError('Time required for the keyboard press is longer than '
-                               'the requested time interval between triggers.')
-        interval -= avg_time
-        start_time = time.time()
-
-        # press key
-        for _ in range(num):
-            pyautogui.press(key)
-            time.sleep(interval)
-        duration = time.time() - start_time
-        print('\nPressed ' + str(num) + ' "' + key + '"s in ' + str(duration) + ' seconds\n')
-
-    except (IndexError, ValueError):
-        print('Invalid argument.\n'
-              'Usage: python trigger_sender.py '
-              '<trigger key> '
-              '<number of triggers> '
-              '<time interval between two triggers (in seconds)>')
+        events = []
+        if args.events:
+            events = read_events(args.events, args.events_column, args.events_time.split(','))
+        backend = make_backend(args.backend, args.key, args.path, **kwargs)
+        events_backend = backend
+        if args.events and (events_backend_name, events_path) != (args.backend, args.path):
+            events_backend = make_backend(events_backend_name, args.key, events_path)  # no --subscribers
+    except ValueError as e:
+        parser.error(str(e))
+    with backend, events_backend:
+        # send triggers (and events)
+        channels = [('trigger', backend, [(k * args.interval, args.key) for k in range(args.num)])]
+        if events:
+            channels.append(('event', events_backend, events))
+        log = play_events(channels)
+    duration = log[-1][4] if log else 0.0
+    report = sys.stderr if 'stdout' in (args.backend, events_backend_name) else sys.stdout  # keep stdout clean
+    print('\nSent ' + str(args.num) + ' "' + args.key + '"s' + (' and %d events' % len(events) if events else '') +
+          ' in ' + str(duration) + ' seconds\n', file=report)
+    for name, _, _ in channels:
+        print_stats(name, log, report)
+    slow = sum(1 for name, _, _, sent, done in log if name == 'trigger' and done - sent > args.interval)
+    if slow:
+        print('Warning: %d triggers took longer to send than the interval between triggers.' % slow, file=report)
+    if args.log:
+        write_emit_log(log, args.log)
 
 
 if __name__ == '__main__':